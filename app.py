@@ -1,17 +1,17 @@
 import streamlit as st
-import json
 import os
 import pandas as pd
-from azure.storage.blob import BlobServiceClient
-from blob_storage import download_pdf_from_blob
-from openai_service import send_to_openai
-from pdf_processing import extract_text_from_pdf, format_to_structure, parse_content_to_json, remove_outside_braces
-from utils import json_to_excel, txttojson
-import io
-import base64
+from blob_storage import download_blob_to_cache, get_blob_service_client, open_pdf_from_blob, list_container_names, list_pdf_blobs
+from insights import InsightStore, build_subsection_units, generate_insights, select_section_units, stream_insights, unit_key
+from jobs import JobManager
+from openai_service import deployment_health, response_cache
+from pdf_processing import EXTRACTION_BACKENDS, PreviewPageCache, count_pdf_pages, iter_pages_from_pdf, parse_structure
+from tracing import Tracer, trace, use_tracer
+from utils import json_to_excel
 import yaml
 from PIL import Image
 import time
+import numpy as np
 import matplotlib.pyplot as plt
 
 with open('config.yaml', 'r') as file:
@@ -24,6 +24,42 @@ with open('config.yaml', 'r') as file:
 storage_connection_string = st.secrets["azure_storage"]["storage_connection_string"]
 evaluation_container_name = st.secrets["azure_storage"]["evaluation_container_name"]
 
+# Container/blob listing: cache lifetime (seconds), PDFs shown per search and Azure page size
+listing_ttl = config.get("blob_listing", {}).get("ttl_seconds", 300)
+listing_max_results = config.get("blob_listing", {}).get("max_results", 500)
+listing_page_size = config.get("blob_listing", {}).get("page_size", 500)
+
+# Also write each run's insight rows to Insights/Insights_{file}.jsonl
+spill_results_jsonl = config.get("processing", {}).get("spill_results_jsonl", False)
+
+# Evaluation mismatches shown per page
+mismatch_page_size = config.get("evaluation", {}).get("mismatch_page_size", 100)
+
+# Rendered PDF preview pages kept in memory per document, and documents kept (least recently used are dropped first)
+preview_cache_pages = config.get("preview", {}).get("cache_pages", 64)
+preview_cache_documents = config.get("preview", {}).get("cache_documents", 8)
+
+# Maximum number of subsections sent to Azure OpenAI at the same time
+max_concurrency = config.get("processing", {}).get("max_concurrency", 8)
+# Small subsections are packed into one request up to this many tokens of contract text
+request_token_budget = config.get("processing", {}).get("request_token_budget", 1800)
+max_subsections_per_request = config.get("processing", {}).get("max_subsections_per_request", 8)
+# Missing or unparseable replies are re-sent per subsection until it has had max_attempts calls, with lenient JSON repair
+max_attempts = config.get("processing", {}).get("max_attempts", 3)
+json_repair = config.get("processing", {}).get("json_repair", True)
+# Worker processes for PDF text extraction (small documents are always extracted serially)
+extraction_workers = config.get("processing", {}).get("extraction_workers") or os.cpu_count() or 1
+default_extraction_backend = config.get("processing", {}).get("extraction_backend", "pdfplumber")
+# Pages per extraction shard when extracting in parallel; smaller shards hand pages to the parser sooner
+extraction_shard_pages = config.get("processing", {}).get("extraction_shard_pages", 8)
+
+# Generation jobs run in background threads shared by all sessions; the UI polls them every job_poll_seconds
+max_running_jobs = config.get("jobs", {}).get("max_running", 2)
+job_poll_seconds = config.get("jobs", {}).get("poll_seconds", 1)
+
+# Record per-stage timings, tokens and memory for each run (shown under "Performance")
+tracing_enabled = config.get("tracing", {}).get("enabled", True)
+
 # Define the output directory (inside the "Insights" folder)
 output_dir = os.path.join("Insights")
 if not os.path.exists(output_dir):
@@ -34,33 +70,186 @@ if "excel_path" not in st.session_state:
     st.session_state.excel_path = None
 if "processing" not in st.session_state:
     st.session_state.processing = False
-if "view_pdf" not in st.session_state:
-    st.session_state.view_pdf = False
-if "pdf_base64" not in st.session_state:
-    st.session_state.pdf_base64 = None
 if "excel_generated" not in st.session_state:
     st.session_state.excel_generated = False
-if "insights_generated" not in st.session_state:
-    st.session_state.insights_generated = False
+if "job_id" not in st.session_state:
+    st.session_state.job_id = None
+if "job_fraction" not in st.session_state:
+    st.session_state.job_fraction = 0.0
+if "job_notice" not in st.session_state:
+    st.session_state.job_notice = None
+if "blob_metadata" not in st.session_state:
+    st.session_state.blob_metadata = {}
+if "insights_df" not in st.session_state:
+    st.session_state.insights_df = None
+if "excel_bytes" not in st.session_state:
+    st.session_state.excel_bytes = None
+if "insights_trace" not in st.session_state:
+    st.session_state.insights_trace = None
+if "outline" not in st.session_state:
+    st.session_state.outline = None
+if "section_rows" not in st.session_state:
+    st.session_state.section_rows = {}
+if "evaluation_results" not in st.session_state:
+    st.session_state.evaluation_results = None
+
+@st.cache_resource
+def get_job_manager():
+    return JobManager(max_running=max_running_jobs)
+
+# Document outline: extraction and structure parsing only (no model calls), cached per document version and backend
+@st.cache_data(show_spinner=False, max_entries=16)
+def document_outline(pdf_path, etag, backend):
+    pages = iter_pages_from_pdf(pdf_path, workers=extraction_workers, backend=backend, shard_pages=extraction_shard_pages)
+    return parse_structure(line for page_text in pages for line in page_text.splitlines())
+
+# PDF preview: page count and rendered pages are cached per document version (path + ETag)
+@st.cache_data(show_spinner=False)
+def preview_page_count(pdf_path, etag):
+    return count_pdf_pages(pdf_path)
+
+@st.cache_resource
+def get_preview_cache():
+    return PreviewPageCache(pages_per_document=preview_cache_pages, max_documents=preview_cache_documents)
 
 # Function to list containers and blobs
+# Listings are cached for listing_ttl seconds so widget interactions don't re-enumerate the storage account
+@st.cache_data(ttl=listing_ttl, show_spinner=False)
+def _cached_container_names():
+    return list_container_names(storage_connection_string)
+
+@st.cache_data(ttl=listing_ttl, show_spinner=False)
+def _cached_pdf_blobs(container_name, prefix):
+    return list_pdf_blobs(storage_connection_string, container_name, prefix, max_results=listing_max_results, page_size=listing_page_size)
+
 def list_containers():
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
-        container_list = blob_service_client.list_containers()
-        return [container.name for container in container_list]
+        return _cached_container_names()
     except Exception as e:
         st.error(f"Error fetching containers: {e}")
         return []
 
-def list_blobs(container_name):
+def list_blobs(container_name, prefix=""):
+    """Return the PDF blob names matching prefix; their size/last-modified/ETag go to st.session_state.blob_metadata."""
     try:
-        container_client = BlobServiceClient.from_connection_string(storage_connection_string).get_container_client(container_name)
-        blob_list = container_client.list_blobs()
-        return [blob.name for blob in blob_list if blob.name.endswith(".pdf")]
+        blobs = _cached_pdf_blobs(container_name, prefix)
     except Exception as e:
         st.error(f"Error fetching blobs: {e}")
         return []
+    st.session_state.blob_metadata = {blob["name"]: blob for blob in blobs}
+    if len(blobs) >= listing_max_results:
+        st.caption(f"Showing the first {listing_max_results} matching PDFs - type more of the name to narrow the list.")
+    return [blob["name"] for blob in blobs]
+
+def run_insights_job(job, container_name, blob_name, etag, output_excel_file, backend, use_cache):
+    """Background job: extract, generate and write the workbook for one PDF, reporting progress on job."""
+    tracer = Tracer(f"Insights {blob_name}") if tracing_enabled else None
+    with use_tracer(tracer):
+        result = generate_document_insights(job, container_name, blob_name, etag, output_excel_file, backend, use_cache)
+    result["trace"] = tracer
+    return result
+
+def generate_document_insights(job, container_name, blob_name, etag, output_excel_file, backend, use_cache):
+    # Memory-mapped view of the locally cached PDF; nothing is copied into Python memory
+    with trace("open_pdf_from_blob", "download"):
+        pdf_data = open_pdf_from_blob(storage_connection_string, container_name, blob_name, etag)
+    try:
+        # Pages are parsed as they are extracted and every finished subsection goes straight to the
+        # model, so the first rows show up while the rest of the PDF is still being read
+        with trace("count_pdf_pages", "extract"):
+            job.update(pages=0, page_count=count_pdf_pages(pdf_data), done=0, total=0)
+
+        def counted_pages():
+            for pages_read, page_text in enumerate(iter_pages_from_pdf(pdf_data, workers=extraction_workers, backend=backend,
+                                                                       shard_pages=extraction_shard_pages), start=1):
+                job.update(pages=pages_read)
+                yield page_text
+
+        cache_stats_before = response_cache.stats()
+        with trace("stream_insights", "pipeline"):
+            content, insights_data, statuses = stream_insights(counted_pages(), max_workers=max_concurrency,
+                                                         progress_callback=lambda done, total: job.update(done=done, total=total),
+                                                         use_cache=use_cache, token_budget=request_token_budget,
+                                                         max_subsections=max_subsections_per_request, row_callback=job.add_row,
+                                                         preview_callback=job.add_row, cancel_event=job.cancel_event, max_attempts=max_attempts, repair=json_repair)
+        cache_stats_after = response_cache.stats()
+    finally:
+        pdf_data.close()
+
+    cache_delta = (cache_stats_after["hits"] - cache_stats_before["hits"], cache_stats_after["misses"] - cache_stats_before["misses"])
+    section_rows = {unit_key(unit): row for unit, row in zip(build_subsection_units(content), insights_data) if row}
+    return save_insights(container_name, blob_name, etag, backend, content, section_rows, statuses, output_excel_file,
+                         cache_delta if use_cache else None)
+
+def run_sections_job(job, container_name, blob_name, etag, backend, content, sections, section_rows, output_excel_file, use_cache):
+    """Background job: generate the chosen sections' subsections that have no row yet and rewrite the workbook with every row so far."""
+    tracer = Tracer(f"Sections of {blob_name}") if tracing_enabled else None
+    with use_tracer(tracer):
+        result = generate_section_insights(job, container_name, blob_name, etag, backend, content, sections, section_rows,
+                                           output_excel_file, use_cache)
+    result["trace"] = tracer
+    return result
+
+def generate_section_insights(job, container_name, blob_name, etag, backend, content, sections, section_rows, output_excel_file,
+                              use_cache):
+    # Only subsections of the selected sections are sent; the rest of the outline costs no model calls
+    pending = select_section_units(content, sections, skip=section_rows)
+    job.update(done=0, total=len(pending))
+    cache_stats_before = response_cache.stats()
+    with trace("generate_insights", "pipeline", subsections=len(pending)):
+        rows, statuses = generate_insights(pending, max_workers=max_concurrency,
+                                           progress_callback=lambda done, total: job.update(done=done, total=total),
+                                           use_cache=use_cache, token_budget=request_token_budget,
+                                           max_subsections=max_subsections_per_request, row_callback=job.add_row,
+                                           preview_callback=job.add_row, cancel_event=job.cancel_event, max_attempts=max_attempts, repair=json_repair)
+    cache_stats_after = response_cache.stats()
+    cache_delta = (cache_stats_after["hits"] - cache_stats_before["hits"], cache_stats_after["misses"] - cache_stats_before["misses"])
+    section_rows = dict(section_rows)
+    section_rows.update({unit_key(unit): row for unit, row in zip(pending, rows) if row})
+    return save_insights(container_name, blob_name, etag, backend, content, section_rows, statuses, output_excel_file,
+                         cache_delta if use_cache else None)
+
+def save_insights(container_name, blob_name, etag, backend, content, section_rows, statuses, output_excel_file, cache_delta):
+    """Write every row generated so far for the document, in document order, and describe the result for the UI."""
+    units = build_subsection_units(content)
+    insight_store = InsightStore([section_rows[unit_key(unit)] for unit in units if unit_key(unit) in section_rows])
+    if spill_results_jsonl:
+        insight_store.to_jsonl(os.path.splitext(output_excel_file)[0] + ".jsonl")
+
+    # Check if the file exists, and if so, delete it
+    if os.path.exists(output_excel_file):
+        os.remove(output_excel_file)
+
+    excel_bytes = None
+    if insight_store.rows:
+        with trace("json_to_excel", "excel", rows=len(insight_store.rows)):
+            json_to_excel(insight_store.rows, output_excel_file)
+        with open(output_excel_file, "rb") as file:
+            excel_bytes = file.read()
+    return {
+        "insights_df": insight_store.dataframe(),
+        "excel_bytes": excel_bytes,
+        "excel_path": output_excel_file,
+        # Subsections that still failed after their retries; answered ones are cached, so a rerun only pays for these
+        "failed": [status for status in statuses if status and status["status"] == "failed"],
+        # Outline and rows by (section, subsection), so later section runs add to this workbook
+        "outline": {"container": container_name, "blob": blob_name, "etag": etag, "backend": backend, "content": content},
+        "section_rows": section_rows,
+        "cache_hits": cache_delta[0] if cache_delta else None,
+        "cache_misses": cache_delta[1] if cache_delta else None
+    }
+
+def outline_matches(outline, container_name, blob_name, etag):
+    # An outline and its rows belong to one version of one blob in one container
+    return bool(outline) and (outline.get("container"), outline["blob"], outline["etag"]) == (container_name, blob_name, etag)
+
+def submit_job(description, target, *args):
+    job = get_job_manager().submit(description, target, *args)
+    st.session_state.job_id = job.id
+    st.session_state.processing = True
+    st.session_state.job_fraction = 0.0
+    st.session_state.job_notice = None
+    st.session_state.evaluation_results = None
 
 # Streamlit UI
 st.set_page_config(page_title="DocsInSights", page_icon=":book:", layout="wide")
@@ -68,7 +257,7 @@ st.set_page_config(page_title="DocsInSights", page_icon=":book:", layout="wide")
 def download_evaluation_file_from_azure_blob(evaluation_container_name, evaluation_excel_blob_name, download_path):
     """Download file from Azure Blob Storage."""
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
+        blob_service_client = get_blob_service_client(storage_connection_string)
         container_client = blob_service_client.get_container_client(evaluation_container_name)
         blob_client = container_client.get_blob_client(evaluation_excel_blob_name)
 
@@ -111,60 +300,87 @@ def calculate_metrics(TP, FP, FN, TN, total_cells):
     F1_Score = 2 * (Precision * Recall) / (Precision + Recall) if (Precision + Recall) > 0 else 0
     return Accuracy, Recall, Precision, F1_Score
 
+def compare_column(expected, generated):
+    """Cell-by-cell outcome of one column: (both missing, equal, mismatch) boolean arrays."""
+    expected_missing = expected.isna().to_numpy()
+    generated_missing = generated.isna().to_numpy()
+    if expected.dtype == generated.dtype:
+        equal = expected.to_numpy() == generated.to_numpy()
+    else:
+        # Mixed dtypes (e.g. numbers read as text on one side) are compared as Python objects, like ==
+        equal = expected.to_numpy(dtype=object) == generated.to_numpy(dtype=object)
+    equal = np.asarray(equal, dtype=bool) & ~expected_missing & ~generated_missing
+    both_missing = expected_missing & generated_missing
+    return both_missing, equal, ~(both_missing | equal)
+
 def compare_dataframes(df1, df2, columns_to_compare):
-    """Compare two dataframes and return the metrics and non-relevant data."""
-    TP = FP = FN = TN = 0
-    non_relevant_data = []
+    """Compare two dataframes and return the metrics, the mismatches and a per-column breakdown.
 
+    Rows are paired by Reference and by their position among the rows sharing
+    that Reference, and each column is compared in one vectorised pass.
+    """
     # Check for missing columns
     missing_columns = [col for col in columns_to_compare if col not in df1.columns or col not in df2.columns]
     if missing_columns:
         st.warning(f"Warning: Missing Columns in the Data – [{', '.join(missing_columns)}]")
         columns_to_compare = [col for col in columns_to_compare if col not in missing_columns]
 
-    # Group by 'Reference' to compare row by row
-    grouped_df1 = df1.groupby('Reference')
-    grouped_df2 = df2.groupby('Reference')
-
-    for reference, group1 in grouped_df1:
-        group2 = grouped_df2.get_group(reference) if reference in grouped_df2.groups else pd.DataFrame()
-
-        for (idx1, row1), (idx2, row2) in zip(group1.iterrows(), group2.iterrows()):
-            for col in columns_to_compare:
-                if col in row1 and col in row2:
-                    val1 = row1[col]
-                    val2 = row2[col]
-
-                    if pd.isna(val1) and pd.isna(val2):
-                        TP += 1
-                    elif pd.isna(val1) or pd.isna(val2):
-                        FP += 1
-                        FN += 1
-                        non_relevant_data.append((val1, val2, col, reference))
-                    elif val1 == val2:
-                        TP += 1
-                    else:
-                        FP += 1
-                        FN += 1
-                        non_relevant_data.append((val1, val2, col, reference))
-
-                    if not pd.isna(val1) and not pd.isna(val2) and val1 != val2:
-                        TN += 1
+    # Pair the n-th row of a Reference in df1 with the n-th row of the same Reference in df2
+    # (rows without a Reference are never compared, and surplus rows on either side are left out)
+    left = df1[df1['Reference'].notna()]
+    right = df2[df2['Reference'].notna()]
+    left = left[columns_to_compare].assign(_reference=left['Reference'].astype(object), _position=left.groupby('Reference').cumcount())
+    right = right[columns_to_compare].assign(_reference=right['Reference'].astype(object), _position=right.groupby('Reference').cumcount())
+    pairs = left.merge(right, on=['_reference', '_position'], suffixes=('_expected', '_generated'))
+    pairs = pairs.sort_values(['_reference', '_position'], kind='stable').reset_index(drop=True)
+
+    column_rows = []
+    mismatch_masks = []
+    for col in columns_to_compare:
+        expected, generated = pairs[f"{col}_expected"], pairs[f"{col}_generated"]
+        both_missing, equal, mismatch = compare_column(expected, generated)
+        col_TP = int(both_missing.sum() + equal.sum())
+        col_FP = col_FN = int(mismatch.sum())
+        # A mismatch where both cells hold a value also counts as a true negative
+        col_TN = int((mismatch & expected.notna().to_numpy() & generated.notna().to_numpy()).sum())
+        column_rows.append((col, col_TP, col_FP, col_FN, col_TN) + calculate_metrics(col_TP, col_FP, col_FN, col_TN, len(df1)))
+        mismatch_masks.append(mismatch)
+
+    column_metrics = pd.DataFrame(column_rows, columns=['Column', 'TP', 'FP', 'FN', 'TN', 'Accuracy', 'Recall', 'Precision', 'F1 Score'])
+    TP, FP, FN, TN = (int(column_metrics[name].sum()) for name in ('TP', 'FP', 'FN', 'TN'))
+
+    # Mismatches in the same order as before: by Reference, then row, then column
+    if columns_to_compare and len(pairs):
+        rows, cols = np.nonzero(np.column_stack(mismatch_masks))
+        expected_values = np.column_stack([pairs[f"{col}_expected"].to_numpy(dtype=object) for col in columns_to_compare])
+        generated_values = np.column_stack([pairs[f"{col}_generated"].to_numpy(dtype=object) for col in columns_to_compare])
+        non_relevant_data = pd.DataFrame({
+            'Reference': pairs['_reference'].to_numpy(dtype=object)[rows],
+            'Column': np.asarray(columns_to_compare, dtype=object)[cols],
+            'Expected': expected_values[rows, cols],
+            'Generated': generated_values[rows, cols]
+        })
+    else:
+        non_relevant_data = pd.DataFrame(columns=['Reference', 'Column', 'Expected', 'Generated'])
 
     total_cells = len(df1) * len(columns_to_compare)
     Accuracy, Recall, Precision, F1_Score = calculate_metrics(TP, FP, FN, TN, total_cells)
     
-    return Accuracy, Recall, Precision, F1_Score, TP, FP, FN, TN, non_relevant_data
+    return Accuracy, Recall, Precision, F1_Score, TP, FP, FN, TN, non_relevant_data, column_metrics
 
 def evaluation(file2, columns_to_compare):
     """Evaluation function triggered by Streamlit button."""
     start_time = time.time()
+    tracer = Tracer("Evaluation") if tracing_enabled else None
 
     local_file1 = 'Insights/evaluation_excel.xlsx'
-    if not download_evaluation_file_from_azure_blob(evaluation_container_name, evaluation_excel_blob_name, local_file1):
+    with use_tracer(tracer), trace("download evaluation file", "download"):
+        downloaded = download_evaluation_file_from_azure_blob(evaluation_container_name, evaluation_excel_blob_name, local_file1)
+    if not downloaded:
         return
 
-    df1, df2 = load_data(local_file1, file2)
+    with use_tracer(tracer), trace("load_data", "evaluation"):
+        df1, df2 = load_data(local_file1, file2)
     if df1 is None or df2 is None:
         return
 
@@ -174,15 +390,22 @@ def evaluation(file2, columns_to_compare):
         TP = len(df1) * len(columns_to_compare)  # All cells match, so TP = total cells
         FP = FN = TN = 0
         Accuracy, Recall, Precision, F1_Score = calculate_metrics(TP, FP, FN, TN, TP)
-        display_results(Accuracy, Recall, Precision, F1_Score, TP, FP, FN, TN)
+        non_relevant_data, column_metrics = None, None
     else:
-        Accuracy, Recall, Precision, F1_Score, TP, FP, FN, TN, non_relevant_data = compare_dataframes(df1, df2, columns_to_compare)
-        display_results(Accuracy, Recall, Precision, F1_Score, TP, FP, FN, TN)
-        display_non_relevant_data(non_relevant_data)
+        with use_tracer(tracer), trace("compare_dataframes", "evaluation", rows=len(df1)):
+            Accuracy, Recall, Precision, F1_Score, TP, FP, FN, TN, non_relevant_data, column_metrics = compare_dataframes(df1, df2, columns_to_compare)
 
     end_time = time.time()
     execution_time = end_time - start_time
-    st.write(f"Execution Time: {execution_time:.2f} seconds")
+
+    # Kept in session state so paging through the mismatches does not rerun the comparison
+    st.session_state.evaluation_results = {
+        "metrics": (Accuracy, Recall, Precision, F1_Score, TP, FP, FN, TN),
+        "non_relevant_data": non_relevant_data,
+        "column_metrics": column_metrics,
+        "execution_time": execution_time,
+        "trace": tracer
+    }
 
     # Cleanup
     try:
@@ -223,12 +446,47 @@ def display_results(Accuracy, Recall, Precision, F1_Score, TP, FP, FN, TN):
             st.pyplot(fig)
 
 
+def display_trace(tracer, key):
+    """Per-stage wall time, tokens, streaming speed and memory growth of a run, with the full trace for offline analysis."""
+    if tracer is None or not tracer.spans:
+        return
+    with st.expander("Performance", expanded=False):
+        summary = pd.DataFrame(tracer.summary())
+        st.dataframe(summary[["stage", "category", "calls", "total_s", "mean_s", "max_s", "prompt_tokens",
+                              "completion_tokens", "mean_ttft_s", "tokens_per_s", "max_mem_growth_mb",
+                              "process_peak_rss_mb"]].round(3), hide_index=True)
+        trace_cols = st.columns(2)
+        with trace_cols[0]:
+            st.download_button("Download trace (JSON)", tracer.to_json(), file_name=f"{key}_trace.json",
+                               mime="application/json", key=f"{key}_trace_json")
+        with trace_cols[1]:
+            st.download_button("Download Chrome trace", tracer.to_chrome_trace(), file_name=f"{key}_chrome_trace.json",
+                               mime="application/json", key=f"{key}_chrome_trace",
+                               help="Open in chrome://tracing or ui.perfetto.dev")
+
+def display_column_metrics(column_metrics):
+    """Display the TP/FP/FN/TN breakdown of each compared column."""
+    if column_metrics is not None and len(column_metrics):
+        st.write("**Per-Column Results:**")
+        st.dataframe(column_metrics, hide_index=True)
+
 def display_non_relevant_data(non_relevant_data):
-    """Display non-relevant data (mismatches) in Streamlit."""
-    if non_relevant_data:
-        st.write("**Non-Relevant Data (Mismatches):**")
-        for val1, val2, col, reference in non_relevant_data:
-            st.write(f"Reference: {reference}, Column: {col}, Expected: {val1}, Generated: {val2}")
+    """Display non-relevant data (mismatches) in Streamlit, one page at a time."""
+    if non_relevant_data is None or non_relevant_data.empty:
+        return
+    st.write(f"**Non-Relevant Data (Mismatches):** {len(non_relevant_data)}")
+
+    filter_col, page_col = st.columns([3, 1])
+    with filter_col:
+        columns = st.multiselect("Columns", list(non_relevant_data['Column'].unique()), key="mismatch_columns")
+    if columns:
+        non_relevant_data = non_relevant_data[non_relevant_data['Column'].isin(columns)]
+
+    page_count = max(1, -(-len(non_relevant_data) // mismatch_page_size))
+    with page_col:
+        page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, key="mismatch_page")
+    start = (page - 1) * mismatch_page_size
+    st.dataframe(non_relevant_data.iloc[start:start + mismatch_page_size], hide_index=True)
 
 # Left Sidebar for file selection and control buttons
 
@@ -261,7 +519,9 @@ with st.sidebar:
     if containers:
         selected_container = st.selectbox("Select Container", containers)
         if selected_container:
-            blobs = list_blobs(selected_container)
+            blob_prefix = st.text_input("Search PDF Files", placeholder="File name starts with...",
+                                        help="Matched by Azure against the start of the blob name (case-sensitive).")
+            blobs = list_blobs(selected_container, blob_prefix)
             if blobs:
                 selected_blob = st.selectbox("Select PDF File", blobs)
                 base_blob_name = selected_blob.replace(".pdf", "")
@@ -270,31 +530,53 @@ with st.sidebar:
                 evaluation_excel_blob_name = f"Evaluation_{base_blob_name}.xlsx"
                 
                 if selected_blob:
-                    pdf_data = download_pdf_from_blob(storage_connection_string, selected_container, selected_blob)
-                    if pdf_data:
-                        if isinstance(pdf_data, io.BytesIO):
-                            pdf_data = pdf_data.read()
-                        pdf_base64 = base64.b64encode(pdf_data).decode('utf-8')
-                        st.session_state.pdf_base64 = pdf_base64
-                        st.session_state.view_pdf = True
+                    backend_names = list(EXTRACTION_BACKENDS)
+                    extraction_backend = st.selectbox("Text Extraction Backend", backend_names,
+                                                      index=backend_names.index(default_extraction_backend),
+                                                      help="pdfplumber is the reference extractor; PyMuPDF is much faster on long contracts.")
+                    use_cache = st.checkbox("Reuse cached model responses", value=True, help="Untick to send every subsection to the model again, even if it was answered before.")
 
                     # Generate and Cancel buttons in columns for layout
                     cols = st.columns([3, 1])
                     with cols[0]:
-                        if st.button("Generate Insights") and not st.session_state.insights_generated:
-                            st.session_state.processing = True
-                            st.session_state.insights_generated = True
-                            # Start processing the PDF (use existing logic here...)
+                        if st.button("Generate Insights") and not st.session_state.processing:
+                            submit_job(f"Insights for {selected_blob}", run_insights_job, selected_container, selected_blob,
+                                       st.session_state.blob_metadata.get(selected_blob, {}).get("etag"),
+                                       os.path.join(output_dir, f"Insights_{base_blob_name}.xlsx"), extraction_backend, use_cache)
                     
                     with cols[1]:
-                        if st.button("Cancel"):
-                            st.session_state.processing = False
-                            st.session_state.insights_generated = False
+                        # Stops pending subsections and abandons in-flight requests of the running job
+                        if st.button("Cancel") and st.session_state.processing:
+                            get_job_manager().cancel(st.session_state.job_id)
+
+                    # Sections and subsections only, without any model call; insights can then be generated per section
+                    if st.button("Show Outline", help="List the document's sections so insights can be generated for selected ones only."):
+                        selected_etag = st.session_state.blob_metadata.get(selected_blob, {}).get("etag")
+                        try:
+                            with st.spinner("Reading the document structure..."):
+                                pdf_path = download_blob_to_cache(storage_connection_string, selected_container, selected_blob, selected_etag)
+                                content = document_outline(pdf_path, selected_etag, extraction_backend)
+                            outline = st.session_state.outline
+                            # Another backend can split the text into other subsections, so its rows don't carry over
+                            if (not outline_matches(outline, selected_container, selected_blob, selected_etag)
+                                    or outline.get("backend") != extraction_backend):
+                                st.session_state.section_rows = {}
+                            st.session_state.outline = {"container": selected_container, "blob": selected_blob, "etag": selected_etag,
+                                                        "backend": extraction_backend, "content": content}
+                        except Exception as e:
+                            st.error(f"Error reading the document outline: {e}")
+            elif blob_prefix:
+                st.error(f"No PDF files starting with '{blob_prefix}' found in container {selected_container}.")
             else:
                 st.error(f"No PDF files found in container {selected_container}.")
     else:
         st.error("No containers found. Please check the Azure Blob Storage configuration.")
 
+    # Requests are balanced over every deployment in openai.deployments; this shows how each one is doing
+    if len(deployment_health()) > 1:
+        with st.expander("Azure OpenAI Deployments"):
+            st.dataframe(pd.DataFrame(deployment_health()), hide_index=True)
+
     with st.expander("Instructions - How to Use DocsInSights"):
         st.markdown(f"""
         **Step 1: Select a Container**
@@ -356,90 +638,116 @@ st.markdown(f"""
     """, unsafe_allow_html=True)
 
 with st.expander("PDF Preview", expanded=False):
-    if st.session_state.view_pdf:
-        # st.markdown(f"**Selected PDF File:** `{selected_blob}`")
-        st.markdown(f'<iframe src="data:application/pdf;base64,{st.session_state.pdf_base64}" width="700" height="600" type="application/pdf"></iframe>', unsafe_allow_html=True)
-
-# Processing section
-if st.session_state.processing:
-    progress_bar = st.progress(0)
-    total_steps = 5
-    step_counter = 0
-    process_text = st.empty()
-    process_text.text("Processing...")
-
-    try:
-        pdf_data = download_pdf_from_blob(storage_connection_string, selected_container, selected_blob)
-        if pdf_data:
-            step_counter += 1
-            progress_bar.progress(step_counter / total_steps)
-
-            raw_text = extract_text_from_pdf(pdf_data)
-            step_counter += 1
-            progress_bar.progress(step_counter / total_steps)
-
-            sections = format_to_structure(raw_text)
-            step_counter += 1
-            progress_bar.progress(step_counter / total_steps)
-
-            content1 = parse_content_to_json(sections)
-            step_counter += 1
-            progress_bar.progress(step_counter / total_steps)
-
-            insights_data = []
-            for section, content in content1.items():
-                if isinstance(content, dict):
-                    for subsection, details in content.items():
-                        if subsection == "No Subsection":
-                            subsection = section
-                        if details:
-                            bullet_points = "\n".join(f"- {item}" for item in details)
-                            subsection_str = f"section_name: {section}\nsubsection_name:{subsection}\nbulletpoints:\n{bullet_points}\n"
-                            section_str = subsection_str
-                            response = send_to_openai(section_str)
-                            clean_response = remove_outside_braces(response)
-                            if clean_response:
-                                data = json.loads(clean_response)
-                                char_limit = 1000
-                                clause_text_lines = data.get("Clause Text", [])
-                                if not isinstance(clause_text_lines, list):
-                                    clause_text_lines = [clause_text_lines]
-
-                                new_clause_text = []
-                                notes_text = ""
-                                current_length = 0
-                                for line in clause_text_lines:
-                                    line_length = len(line)
-                                    if current_length + line_length <= char_limit:
-                                        new_clause_text.append(line)
-                                        current_length += line_length
-                                    else:
-                                        notes_text += line + " "
-
-                                data["Clause Text"] = new_clause_text
-                                data["Notes"] = notes_text.strip()
-
-                                with open(f"{base_blob_name}.txt", "a") as f:
-                                    f.write(f"\n{json.dumps(data, indent=4)}")
-
-            output_excel_file = os.path.join(output_dir, f"Insights_{base_blob_name}.xlsx")
-
-            # Check if the file exists, and if so, delete it
-            if os.path.exists(output_excel_file):
-                os.remove(output_excel_file)
-
-            response = txttojson(f"{base_blob_name}.txt")
-            if response:
-                json_to_excel(response, output_excel_file, selected_blob)
-                step_counter += 1
-                progress_bar.progress(step_counter / total_steps)
-                process_text.text("✅ Insights Successfully Generated.")
-                st.session_state.excel_path = output_excel_file
-                st.session_state.excel_generated = True
+    # Pages are rendered one at a time on demand; nothing is fetched or sent until the preview is switched on
+    if st.toggle("Show pages", key="show_pdf_preview"):
+        try:
+            selected_etag = st.session_state.blob_metadata.get(selected_blob, {}).get("etag")
+            pdf_path = download_blob_to_cache(storage_connection_string, selected_container, selected_blob, selected_etag)
+            page_count = preview_page_count(pdf_path, selected_etag)
+            page_cols = st.columns([1, 1, 2])
+            with page_cols[0]:
+                preview_page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=max(page_count, 1), value=1, step=1)
+            with page_cols[1]:
+                preview_zoom = st.select_slider("Zoom", options=[0.5, 0.75, 1.0, 1.25, 1.5], value=1.0)
+            if page_count:
+                st.image(get_preview_cache().render(pdf_path, selected_etag, preview_page - 1, preview_zoom))
+        except Exception as e:
+            st.error(f"Error rendering PDF preview: {e}")
+
+# Document outline: generate insights for chosen sections only, adding to what was generated before
+outline = st.session_state.outline
+if outline and not outline_matches(outline, selected_container, selected_blob,
+                                   st.session_state.blob_metadata.get(selected_blob, {}).get("etag")):
+    # Another container, another blob or a new version of it is selected: the outline and its rows don't apply
+    st.session_state.outline = outline = None
+    st.session_state.section_rows = {}
+if outline and outline["content"]:
+    with st.expander("Document Outline", expanded=True):
+        section_rows = st.session_state.section_rows
+        outline_units = build_subsection_units(outline["content"])
+        section_names = list(outline["content"])
+        outline_table = pd.DataFrame([{
+            "Section": section,
+            "Subsections": sum(unit[0] == section for unit in outline_units),
+            "Generated": sum(unit[0] == section and unit_key(unit) in section_rows for unit in outline_units)
+        } for section in section_names])
+        st.dataframe(outline_table, hide_index=True)
+        chosen_sections = st.multiselect("Sections to generate", section_names)
+        pending_units = select_section_units(outline["content"], chosen_sections, skip=section_rows)
+        st.caption(f"{len(pending_units)} subsection(s) of the selected sections still to generate; "
+                   "other sections cost no model calls until they are selected.")
+        if st.button("Generate Selected Sections", disabled=st.session_state.processing or not pending_units):
+            submit_job(f"Sections of {selected_blob}", run_sections_job, outline["container"], selected_blob, outline["etag"],
+                       outline["backend"], outline["content"], chosen_sections, section_rows,
+                       os.path.join(output_dir, f"Insights_{base_blob_name}.xlsx"), use_cache)
+
+# Processing section: the job runs in the background and this fragment polls its progress
+@st.fragment(run_every=job_poll_seconds)
+def show_job_progress():
+    job = get_job_manager().get(st.session_state.job_id)
+    if job is None:
+        st.session_state.processing = False
+        st.rerun()
+    snapshot = job.snapshot()
+    progress = snapshot["progress"]
+    page_count = max(progress.get("page_count", 0), 1)
+
+    if "page_count" in progress:
+        # First half of the bar follows extraction, second half the subsections found so far
+        fraction = 0.5 * progress.get("pages", 0) / page_count
+        if progress.get("total"):
+            fraction += 0.5 * progress["done"] / progress["total"] * progress.get("pages", 0) / page_count
+    else:
+        # Section runs start from a parsed outline, so only the subsections are left to follow
+        fraction = progress.get("done", 0) / max(progress.get("total", 0), 1)
+    st.session_state.job_fraction = min(1.0, max(st.session_state.job_fraction, fraction))
+    st.progress(st.session_state.job_fraction)
+    if snapshot["status"] == "cancelling":
+        st.text("Cancelling...")
+    elif snapshot["status"] == "queued":
+        st.text("Waiting for a free worker...")
+    elif "page_count" in progress:
+        st.text(f"Reading page {progress.get('pages', 0)}/{progress.get('page_count', 0)} - "
+                f"{progress.get('done', 0)}/{progress.get('total', 0)} subsections generated")
+    else:
+        st.text(f"{progress.get('done', 0)}/{progress.get('total', 0)} subsections generated")
+    if snapshot["rows"]:
+        st.dataframe(pd.DataFrame(snapshot["rows"]))
 
-    except Exception as e:
-        st.error(f"Error during processing: {e}")
+    if job.is_finished:
         st.session_state.processing = False
+        if snapshot["status"] == "done":
+            st.session_state.outline = job.result["outline"]
+            st.session_state.section_rows = job.result["section_rows"]
+        if snapshot["status"] == "done" and job.result["excel_bytes"]:
+            # Keep the preview table and the workbook bytes in the session so reruns don't touch the disk
+            st.session_state.insights_df = job.result["insights_df"]
+            st.session_state.excel_bytes = job.result["excel_bytes"]
+            st.session_state.excel_path = job.result["excel_path"]
+            st.session_state.insights_trace = job.result["trace"]
+            st.session_state.excel_generated = True
+            notice = "✅ Insights Successfully Generated."
+            if job.result["cache_hits"] is not None:
+                notice += f" Response cache: {job.result['cache_hits']} hits, {job.result['cache_misses']} misses."
+            if job.result["failed"]:
+                failed_names = ", ".join(status["subsection"] for status in job.result["failed"][:10])
+                notice += (f" {len(job.result['failed'])} subsection(s) could not be generated ({failed_names}); "
+                           "generate again to retry only those.")
+            st.session_state.job_notice = ("warning" if job.result["failed"] else "success", notice)
+        elif snapshot["status"] == "done":
+            error = job.result["failed"][0]["error"] if job.result["failed"] else "no subsections found"
+            st.session_state.job_notice = ("warning", f"No insights could be generated for this document ({error}).")
+        elif snapshot["status"] == "cancelled":
+            st.session_state.job_notice = ("warning", f"Insight generation cancelled after {snapshot['elapsed']:.0f}s.")
+        else:
+            st.session_state.job_notice = ("error", f"Error during processing: {snapshot['error']}")
+        st.rerun()
+
+if st.session_state.processing:
+    show_job_progress()
+elif st.session_state.job_notice:
+    notice_kind, notice_text = st.session_state.job_notice
+    getattr(st, notice_kind)(notice_text)
 
 # Excel file preview and download
 if st.session_state.excel_generated:
@@ -456,25 +764,15 @@ if st.session_state.excel_generated:
 
     with cols[1]:
         # Download button in the second column, aligned to the right
-        with open(st.session_state.excel_path, "rb") as file:
-            excel_data = file.read()
-
         st.download_button(
             label="Download Insights",
-            data=excel_data,
+            data=st.session_state.excel_bytes,
             file_name=os.path.basename(st.session_state.excel_path),
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
     
-    with open(st.session_state.excel_path, "rb") as file:
-        excel_data = file.read()
-
-    excel_file = io.BytesIO(excel_data)
-    df = pd.read_excel(excel_file, engine='openpyxl')
-    st.dataframe(df)
-
-    st.session_state.processing = False
-    st.session_state.insights_generated = False
+    st.dataframe(st.session_state.insights_df)
+    display_trace(st.session_state.insights_trace, "insights")
 
     file2 = f"Insights/Insights_{base_blob_name}.xlsx"
     st.markdown("<h4 style='font-weight: bold;'>Evaluatation</h4>", unsafe_allow_html=True)
@@ -485,3 +783,11 @@ if st.session_state.excel_generated:
 
     if file2 is not None and st.button("Evaluate"):
         evaluation(file2, columns_to_compare)
+
+    if st.session_state.evaluation_results:
+        evaluation_results = st.session_state.evaluation_results
+        display_results(*evaluation_results["metrics"])
+        display_column_metrics(evaluation_results["column_metrics"])
+        display_non_relevant_data(evaluation_results["non_relevant_data"])
+        st.write(f"Execution Time: {evaluation_results['execution_time']:.2f} seconds")
+        display_trace(evaluation_results["trace"], "evaluation")
@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import yaml
+import streamlit as st
+from blob_storage import list_pdf_blobs, open_pdf_from_blob
+from insights import InsightStore, stream_insights
+from openai_service import deployment_health, hedge_stats, limit_concurrent_requests, response_cache, usage_stats
+from pdf_processing import EXTRACTION_BACKENDS, iter_pages_from_pdf
+from tracing import Tracer, trace, use_tracer
+from utils import json_to_excel
+
+# Headless batch processing of every PDF in a container, resumable after a crash.
+# usage: python batch.py contracts-container
+#        python batch.py contracts-container --prefix 2024/ --documents 4 --max-requests 24
+
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file)
+
+batch_config = config.get("batch", {})
+processing_config = config.get("processing", {})
+
+class BatchCheckpoint:
+    """Per-document state of a batch run, kept in a JSON file that is rewritten after every change.
+
+    A document is only skipped on a later run when it finished and its ETag is
+    unchanged; anything that failed, was cut short or changed in Azure is
+    processed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.documents = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as state_file:
+                self.documents = json.load(state_file)
+
+    def is_done(self, blob):
+        state = self.documents.get(blob["name"])
+        return bool(state) and state["status"] == "done" and state.get("etag") == blob["etag"]
+
+    def update(self, blob_name, **fields):
+        with self.lock:
+            self.documents.setdefault(blob_name, {}).update(fields)
+            # Written next to the final path and swapped in, so a crash never leaves a half-written file
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.path) or ".", suffix=".part",
+                                             delete=False, encoding="utf-8") as temp_file:
+                json.dump(self.documents, temp_file, indent=2, default=str)
+            os.replace(temp_file.name, self.path)
+
+def process_document(connection_string, container_name, blob, output_dir, max_workers=8, backend="pdfplumber",
+                     extraction_workers=1, shard_pages=None, use_cache=True, token_budget=1800, max_subsections=8,
+                     save_trace=False):
+    """Run one PDF through the same pipeline as the app and write its workbook and JSONL rows to output_dir.
+
+    With save_trace, a Chrome trace of the document's stages is written next to the workbook.
+    """
+    tracer = Tracer(f"Insights {blob['name']}") if save_trace else None
+    with use_tracer(tracer):
+        result, output_base = _process_document(connection_string, container_name, blob, output_dir, max_workers, backend,
+                                                extraction_workers, shard_pages, use_cache, token_budget, max_subsections)
+    if tracer:
+        with open(output_base + ".trace.json", "w", encoding="utf-8") as trace_file:
+            trace_file.write(tracer.to_chrome_trace())
+    return result
+
+def _process_document(connection_string, container_name, blob, output_dir, max_workers, backend,
+                      extraction_workers, shard_pages, use_cache, token_budget, max_subsections):
+    with trace("open_pdf_from_blob", "download"):
+        pdf_data = open_pdf_from_blob(connection_string, container_name, blob["name"], blob["etag"])
+    pages = []
+
+    def counted_pages():
+        for page_text in iter_pages_from_pdf(pdf_data, workers=extraction_workers, backend=backend, shard_pages=shard_pages):
+            pages.append(len(page_text))
+            yield page_text
+
+    try:
+        with trace("stream_insights", "pipeline"):
+            _, rows, statuses = stream_insights(counted_pages(), max_workers=max_workers, use_cache=use_cache,
+                                                token_budget=token_budget, max_subsections=max_subsections,
+                                                max_attempts=processing_config.get("max_attempts", 3),
+                                                repair=processing_config.get("json_repair", True))
+    finally:
+        pdf_data.close()
+
+    insight_store = InsightStore(rows)
+    # Virtual folders in the blob name are mirrored under output_dir
+    blob_folder, base_blob_name = os.path.split(blob["name"].replace(".pdf", ""))
+    output_base = os.path.join(output_dir, blob_folder, f"Insights_{base_blob_name}")
+    output_excel_file = output_base + ".xlsx"
+    os.makedirs(os.path.dirname(output_base), exist_ok=True)
+    insight_store.to_jsonl(output_base + ".jsonl")
+    if insight_store.rows:
+        with trace("json_to_excel", "excel", rows=len(insight_store.rows)):
+            json_to_excel(insight_store.rows, output_excel_file)
+    return {
+        "pages": len(pages),
+        "subsections": len(rows),
+        "rows": len(insight_store.rows),
+        # Subsections the model gave nothing usable for; the document is retried on the next run
+        "missing_rows": len(rows) - len(insight_store.rows),
+        "failed_subsections": [{"section": status["section"], "subsection": status["subsection"], "error": status["error"]}
+                               for status in statuses if status and status["status"] == "failed"],
+        "output": output_excel_file if insight_store.rows else None
+    }, output_base
+
+def run_batch(connection_string, container_name, prefix="", output_dir=None, documents=2, max_requests=16,
+              max_workers=8, backend="pdfplumber", extraction_workers=None, shard_pages=None, use_cache=True,
+              token_budget=1800, max_subsections=8, max_documents=None, save_trace=False):
+    """Process every PDF in the container with documents in parallel and at most max_requests LLM calls in flight."""
+    output_dir = output_dir or os.path.join(batch_config.get("output_directory", os.path.join("Insights", "batch")), container_name)
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = BatchCheckpoint(os.path.join(output_dir, "batch_state.json"))
+    # Split the CPUs between the documents being extracted at the same time
+    extraction_workers = extraction_workers or max(1, (os.cpu_count() or 1) // max(1, documents))
+    limit_concurrent_requests(max_requests)
+
+    blobs = list_pdf_blobs(connection_string, container_name, prefix, max_results=max_documents or sys.maxsize)
+    pending = [blob for blob in blobs if not checkpoint.is_done(blob)]
+    print(f"{len(blobs)} PDFs in {container_name}/{prefix}: {len(blobs) - len(pending)} already done, {len(pending)} to process")
+
+    usage_before = usage_stats()
+    cache_before = response_cache.stats()
+    start = time.perf_counter()
+    done = failed = 0
+
+    def run_one(blob):
+        checkpoint.update(blob["name"], status="running", etag=blob["etag"], started=time.time())
+        document_start = time.perf_counter()
+        result = process_document(connection_string, container_name, blob, output_dir, max_workers, backend,
+                                  extraction_workers, shard_pages, use_cache, token_budget, max_subsections, save_trace)
+        result["seconds"] = round(time.perf_counter() - document_start, 2)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, documents)) as executor:
+        futures = {executor.submit(run_one, blob): blob for blob in pending}
+        for future in as_completed(futures):
+            blob = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                checkpoint.update(blob["name"], status="failed", error=str(e))
+                print(f"FAILED {blob['name']}: {e}")
+                continue
+            status = "done" if result["missing_rows"] == 0 else "incomplete"
+            done += status == "done"
+            failed += status != "done"
+            checkpoint.update(blob["name"], status=status, error=None, **result)
+            print(f"{status:<10} {blob['name']}: {result['pages']} pages, {result['rows']}/{result['subsections']} rows in {result['seconds']}s")
+
+    elapsed = time.perf_counter() - start
+    usage_after = usage_stats()
+    cache_after = response_cache.stats()
+    tokens = usage_after["total_tokens"] - usage_before["total_tokens"]
+    minutes = max(elapsed, 1e-9) / 60
+    summary = {
+        "documents_done": done,
+        "documents_failed": failed,
+        "documents_skipped": len(blobs) - len(pending),
+        "elapsed_seconds": round(elapsed, 1),
+        "docs_per_minute": round(done / minutes, 2),
+        "requests": usage_after["requests"] - usage_before["requests"],
+        "tokens": tokens,
+        "tokens_per_minute": round(tokens / minutes),
+        "cache_hits": cache_after["hits"] - cache_before["hits"],
+        "cache_misses": cache_after["misses"] - cache_before["misses"],
+        "deployments": deployment_health(),
+        "hedging": hedge_stats()
+    }
+    print(f"Processed {done} documents ({failed} failed, {summary['documents_skipped']} skipped) in {elapsed:.1f}s: "
+          f"{summary['docs_per_minute']} docs/min, {summary['tokens_per_minute']} tokens/min "
+          f"({summary['tokens']} tokens in {summary['requests']} requests, {summary['cache_hits']} cache hits)")
+    if summary["hedging"] and summary["hedging"]["hedges"]:
+        print(f"  {summary['hedging']['hedges']} slow requests hedged ({summary['hedging']['hedge_wins']} won by the hedge), "
+              f"hedge delay {summary['hedging']['hedge_delay_seconds']}s")
+    if len(summary["deployments"]) > 1:
+        for health in summary["deployments"]:
+            print(f"  {health['deployment']}: {health['requests']} requests, {health['failures']} failures, "
+                  f"{health['throttled']} throttled, {health['latency_ms']} ms")
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate insights for every PDF in an Azure Blob Storage container")
+    parser.add_argument("container", help="Container holding the contract PDFs")
+    parser.add_argument("--prefix", default="", help="Only process blobs whose name starts with this prefix")
+    parser.add_argument("--output-dir", help="Where workbooks and the checkpoint go (default: batch.output_directory/<container>)")
+    parser.add_argument("--documents", type=int, default=batch_config.get("documents_in_parallel", 2), help="Documents processed at the same time")
+    parser.add_argument("--max-requests", type=int, default=batch_config.get("max_concurrent_requests", 16), help="LLM requests in flight across all documents")
+    parser.add_argument("--per-document-requests", type=int, default=processing_config.get("max_concurrency", 8), help="LLM requests in flight per document")
+    parser.add_argument("--backend", choices=list(EXTRACTION_BACKENDS), default=processing_config.get("extraction_backend", "pdfplumber"))
+    parser.add_argument("--extraction-workers", type=int, default=processing_config.get("extraction_workers"), help="Extraction processes per document")
+    parser.add_argument("--max-documents", type=int, help="Stop listing after this many PDFs")
+    parser.add_argument("--no-cache", action="store_true", help="Send every subsection to the model again, even if it was answered before")
+    parser.add_argument("--trace", action="store_true", help="Write a Chrome trace (Insights_<name>.trace.json) per document")
+    parser.add_argument("--connection-string", help="Storage connection string (default: AZURE_STORAGE_CONNECTION_STRING, then Streamlit secrets)")
+    args = parser.parse_args()
+
+    connection_string = (args.connection_string or os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
+                         or st.secrets["azure_storage"]["storage_connection_string"])
+    run_batch(connection_string, args.container, prefix=args.prefix, output_dir=args.output_dir, documents=args.documents,
+              max_requests=args.max_requests, max_workers=args.per_document_requests, backend=args.backend,
+              extraction_workers=args.extraction_workers, shard_pages=processing_config.get("extraction_shard_pages", 8),
+              use_cache=not args.no_cache, token_budget=processing_config.get("request_token_budget", 1800),
+              max_subsections=processing_config.get("max_subsections_per_request", 8), max_documents=args.max_documents,
+              save_trace=args.trace)
+
+if __name__ == "__main__":
+    main()
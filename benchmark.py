@@ -0,0 +1,679 @@
+import argparse
+import difflib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import openpyxl
+from openpyxl.styles import Alignment, PatternFill
+import pymupdf
+import openai_service
+from insights import InsightStore, stream_insights
+from pdf_processing import BULLET_PATTERN, EXTRACTION_BACKENDS, HEADING_PATTERN, REMOVAL_PATTERN, SECTION_PATTERN, SUBSECTION_PATTERN, count_pdf_pages, extract_text_from_pdf, iter_pages_from_pdf, parse_structure
+from deployments import Deployment, DeploymentPool
+from rate_limiter import RateLimiter
+from tracing import Tracer, trace, use_tracer
+from utils import EXCEL_COLUMN_WIDTHS, EXCEL_HEADER_FILL, EXCEL_HEADER_HEIGHT, EXCEL_ROW_HEIGHT, EXCEL_WRAP_COLUMNS, insights_dataframe, json_to_excel, write_insights_excel
+
+# Performance harnesses for the processing pipeline.
+# usage: python benchmark.py backends contract.pdf
+#        python benchmark.py parser --sections 300
+#        python benchmark.py excel --rows 1000 10000 50000
+#        python benchmark.py pipeline --sections 40 --latency 1.0 --error-rate 0.05
+#        python benchmark.py pipeline --sections 20 --quota-tpm 300000 [--no-rate-limit]
+#        python benchmark.py pipeline --deployments 3 --quota-tpm 100000 --failing-deployment
+#        python benchmark.py pipeline --sections 60 --slow-share 0.05 --slow-seconds 15 [--no-hedging]
+#        python benchmark.py mock-server --port 8000 --latency 1.5
+
+SECTION_TITLES = ["BACKGROUND, OBJECTIVES AND STRUCTURE", "DEFINITIONS", "SERVICES", "TERM AND RENEWAL", "GOVERNANCE",
+                  "SERVICE LEVELS", "FEES AND PAYMENT", "INTELLECTUAL PROPERTY", "CONFIDENTIALITY", "TERMINATION"]
+FILLER_WORDS = ("vendor shall provide customer services functions tasks responsibilities agreement term notice "
+                "written consent reasonable efforts including without limitation pursuant to exhibit").split()
+
+def synthetic_contract_lines(sections=100, subsections=5, bullets=4, lines_per_bullet=3, seed=0):
+    """Raw text lines shaped like an extracted MSA: numbered sections, subsections and (a)/(b) bullets."""
+    rng = random.Random(seed)
+    lines = []
+    for section in range(1, sections + 1):
+        lines.append(f"{section}. {SECTION_TITLES[section % len(SECTION_TITLES)]}")
+        for subsection in range(1, subsections + 1):
+            lines.append(f"{section}.{subsection} {' '.join(rng.choices(FILLER_WORDS, k=3)).title()}")
+            lines.append(" ".join(rng.choices(FILLER_WORDS, k=14)))
+            for bullet in range(bullets):
+                lines.append(f"({chr(ord('a') + bullet)}) " + " ".join(rng.choices(FILLER_WORDS, k=12)))
+                for _ in range(lines_per_bullet - 1):
+                    lines.append(" ".join(rng.choices(FILLER_WORDS, k=14)))
+            if rng.random() < 0.1:
+                lines.append(f"{rng.randint(1, 99)} Master Services Agreement 24336663.35")
+    return lines
+
+def structure_drift(baseline, candidate):
+    """Compare two parse_content_to_json trees and describe how far candidate drifts from baseline."""
+    baseline_keys = {(section, subsection) for section, subsections in baseline.items() for subsection in subsections}
+    candidate_keys = {(section, subsection) for section, subsections in candidate.items() for subsection in subsections}
+    shared_keys = baseline_keys & candidate_keys
+    union_keys = baseline_keys | candidate_keys
+
+    similarities = []
+    for section, subsection in shared_keys:
+        baseline_text = "\n".join(baseline[section][subsection])
+        candidate_text = "\n".join(candidate[section][subsection])
+        similarities.append(difflib.SequenceMatcher(None, baseline_text, candidate_text, autojunk=False).ratio())
+
+    return {
+        "sections": len(candidate),
+        "subsections": len(candidate_keys),
+        "key_overlap": len(shared_keys) / len(union_keys) if union_keys else 1.0,
+        "text_similarity": sum(similarities) / len(similarities) if similarities else 0.0
+    }
+
+def compare_backends(pdf_path, runs=1, workers=1):
+    """Time every extraction backend on pdf_path and measure its structure drift from pdfplumber."""
+    page_count = count_pdf_pages(pdf_path)
+    results = {}
+    for backend in EXTRACTION_BACKENDS:
+        elapsed = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            text = extract_text_from_pdf(pdf_path, workers=workers, backend=backend)
+            elapsed.append(time.perf_counter() - start)
+        best = min(elapsed)
+        results[backend] = {
+            "seconds": best,
+            "pages_per_second": page_count / best if best else float("inf"),
+            "content": parse_structure(text.splitlines())
+        }
+
+    baseline = results["pdfplumber"]["content"]
+    print(f"{pdf_path}: {page_count} pages, best of {runs} run(s), {workers} worker(s)")
+    print(f"{'backend':<12}{'seconds':>10}{'pages/s':>10}{'sections':>10}{'subsecs':>10}{'key overlap':>13}{'text sim':>10}")
+    for backend, result in results.items():
+        drift = structure_drift(baseline, result["content"])
+        print(f"{backend:<12}{result['seconds']:>10.2f}{result['pages_per_second']:>10.1f}"
+              f"{drift['sections']:>10}{drift['subsections']:>10}{drift['key_overlap']:>13.3f}{drift['text_similarity']:>10.3f}")
+    return results
+
+def format_to_structure(text):
+    """First pass of the original two-pass parser: clean each line and indent it by kind."""
+    formatted_text = ""
+    for line in text.splitlines():
+        clean_line = REMOVAL_PATTERN.sub("", line).strip()
+        if HEADING_PATTERN.match(clean_line):
+            formatted_text += f"\n{clean_line}\n"
+        elif SUBSECTION_PATTERN.match(clean_line):
+            formatted_text += f"{clean_line}\n"
+        elif BULLET_PATTERN.match(clean_line):
+            formatted_text += f"    {clean_line}\n"
+        else:
+            formatted_text += f"        {clean_line}\n"
+    return formatted_text
+
+def parse_content_to_json(text):
+    """Second pass of the original two-pass parser; the reference parse_structure is checked against."""
+    content = {}
+    section_key = None
+    subsection_key = None
+    accumulated_text = ""
+
+    def flush():
+        if accumulated_text:
+            content[section_key].setdefault(subsection_key or "No Subsection", []).append(accumulated_text)
+
+    for line in text.splitlines():
+        line = line.strip()
+
+        section_match = SECTION_PATTERN.match(line)
+        if section_match:
+            flush()
+            accumulated_text = ""
+            section_key = f"{section_match.group(1)} {section_match.group(2).strip()}"
+            content[section_key] = {}
+            subsection_key = None
+            continue
+
+        subsection_match = SUBSECTION_PATTERN.match(line)
+        if subsection_match and section_key:
+            flush()
+            accumulated_text = ""
+            subsection_key = f"{subsection_match.group(1)} {subsection_match.group(2).strip()}"
+            content[section_key][subsection_key] = []
+            continue
+
+        bullet_match = BULLET_PATTERN.match(line)
+        if bullet_match:
+            flush()
+            accumulated_text = f"({bullet_match.group(1)}) {bullet_match.group(2).strip()}"
+        elif section_key:
+            accumulated_text += " " + line
+
+    flush()
+    return content
+
+def benchmark_parser(sections=300, runs=3):
+    """Time format_to_structure + parse_content_to_json against the single-pass parse_structure."""
+    lines = synthetic_contract_lines(sections=sections)
+    text = "\n".join(lines) + "\n"
+
+    def best_of(function):
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = function()
+            timings.append(time.perf_counter() - start)
+        return min(timings), result
+
+    two_pass_seconds, two_pass = best_of(lambda: parse_content_to_json(format_to_structure(text)))
+    single_pass_seconds, single_pass = best_of(lambda: parse_structure(text.splitlines()))
+    if two_pass != single_pass:
+        raise AssertionError("parse_structure output differs from parse_content_to_json(format_to_structure(...))")
+
+    print(f"{len(lines)} lines, {len(text) / 1024 / 1024:.1f} MB, best of {runs} run(s)")
+    print(f"format_to_structure + parse_content_to_json: {two_pass_seconds:.3f}s")
+    print(f"parse_structure:                             {single_pass_seconds:.3f}s ({two_pass_seconds / single_pass_seconds:.1f}x)")
+
+def synthetic_insight_rows(count, seed=0):
+    """Rows shaped like the model's JSON blocks after split_clause_text."""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        section = i // 5 + 1
+        rows.append({
+            "Major Area": "MSA",
+            "Reference": f"{section}. {SECTION_TITLES[section % len(SECTION_TITLES)]}",
+            "Task Description": "",
+            "Manager": "TBD",
+            "Owner": "TBD",
+            "Status": "Green",
+            "Risk": rng.choice(["Low", "Medium", "High"]),
+            "Frequency": rng.choice(["As Required", "Monthly", "Annually"]),
+            "Category": rng.choice(["Governance", "Financials", "Termination"]),
+            "Clause Text": [f"{section}.{i % 5 + 1} Subsection"] + [f"({chr(ord('a') + b)}) " + " ".join(rng.choices(FILLER_WORDS, k=25)) for b in range(3)],
+            "Notes": " ".join(rng.choices(FILLER_WORDS, k=rng.choice([0, 20]))),
+            "Assigned To": "NA"
+        })
+    return rows
+
+def _workbook_snapshot(path):
+    sheet = openpyxl.load_workbook(path).active
+    cells = [[(cell.value, cell.alignment.horizontal, cell.alignment.vertical, cell.alignment.wrap_text, cell.fill.fgColor.rgb)
+              for cell in row] for row in sheet.iter_rows()]
+    heights = {row: sheet.row_dimensions[row].height for row in range(1, sheet.max_row + 1)}
+    widths = {col: sheet.column_dimensions[col].width for col in "ABCDEFGHIJK"}
+    return sheet.title, cells, heights, widths
+
+def formatting_excel(excel_file):
+    """The original formatting pass over a to_excel workbook, kept as the reference for write_insights_excel."""
+    workbook = openpyxl.load_workbook(excel_file)
+    sheet = workbook.active
+    for col, width in EXCEL_COLUMN_WIDTHS.items():
+        sheet.column_dimensions[col].width = width
+    sheet.row_dimensions[1].height = EXCEL_HEADER_HEIGHT
+    header_fill = PatternFill(start_color=EXCEL_HEADER_FILL, end_color=EXCEL_HEADER_FILL, fill_type="solid")
+    for cell in sheet[1]:
+        cell.fill = header_fill
+    for row in range(2, sheet.max_row + 1):
+        sheet.row_dimensions[row].height = EXCEL_ROW_HEIGHT
+    for row in sheet.iter_rows(min_row=1, max_row=sheet.max_row, min_col=1, max_col=sheet.max_column):
+        for cell in row:
+            if cell.column_letter in EXCEL_WRAP_COLUMNS:
+                cell.alignment = Alignment(vertical="top", wrap_text=True)
+            else:
+                cell.alignment = Alignment(horizontal="center", vertical="center")
+    workbook.save(excel_file)
+
+def benchmark_excel(row_counts=(1000, 10000, 50000)):
+    """Time to_excel + formatting_excel against the single-pass write_insights_excel."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        sample = synthetic_insight_rows(50)
+        two_pass_path = os.path.join(work_dir, "two_pass.xlsx")
+        single_pass_path = os.path.join(work_dir, "single_pass.xlsx")
+        insights_dataframe(sample).to_excel(two_pass_path, index=False)
+        formatting_excel(two_pass_path)
+        write_insights_excel(sample, single_pass_path)
+        if _workbook_snapshot(two_pass_path) != _workbook_snapshot(single_pass_path):
+            raise AssertionError("write_insights_excel output differs from to_excel + formatting_excel")
+
+        print(f"{'rows':>8}{'to_excel + formatting_excel':>30}{'write_insights_excel':>24}")
+        for count in row_counts:
+            rows = synthetic_insight_rows(count)
+            start = time.perf_counter()
+            insights_dataframe(rows).to_excel(two_pass_path, index=False)
+            formatting_excel(two_pass_path)
+            two_pass_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            write_insights_excel(rows, single_pass_path)
+            single_pass_seconds = time.perf_counter() - start
+            print(f"{count:>8}{two_pass_seconds:>29.2f}s{single_pass_seconds:>19.2f}s ({two_pass_seconds / single_pass_seconds:.1f}x)")
+
+def synthetic_contract_pdf(path, sections=20, subsections=5, bullets=4, lines_per_bullet=3, lines_per_page=60, seed=0):
+    """Write synthetic_contract_lines to a PDF, lines_per_page lines per page; returns the page count."""
+    lines = synthetic_contract_lines(sections, subsections, bullets, lines_per_bullet, seed)
+    document = pymupdf.open()
+    for first in range(0, len(lines), lines_per_page):
+        page = document.new_page(width=612, height=792)
+        for offset, line in enumerate(lines[first:first + lines_per_page]):
+            page.insert_text((36, 48 + offset * 11.5), line, fontsize=7.5)
+    page_count = document.page_count
+    document.save(path)
+    document.close()
+    return page_count
+
+def canned_insight_blocks(prompt_text):
+    """The JSON blocks a well-behaved model returns for a (possibly packed) subsection prompt."""
+    chunks = re.split(r"\n### Subsection \d+\n", prompt_text)
+    packed = len(chunks) > 1
+    blocks = []
+    for number, chunk in enumerate(chunks[1:] if packed else chunks, start=1):
+        section = re.search(r"section_name: (.*)", chunk)
+        subsection = re.search(r"subsection_name:(.*)", chunk)
+        block = {
+            "Major Area": "MSA",
+            "Reference": section.group(1) if section else "",
+            "Task Description": "",
+            "Manager": "TBD",
+            "Owner": "TBD",
+            "Status": "Green",
+            "Risk": "Low",
+            "Frequency": "As Required",
+            "Category": "Contract Administration",
+            "Clause Text": [subsection.group(1) if subsection else ""] + [line[2:] for line in chunk.splitlines() if line.startswith("- ")],
+            "Notes": "",
+            "Assigned To": "NA"
+        }
+        if packed:
+            block["Block"] = number
+        blocks.append(json.dumps(block, indent=4))
+    return blocks
+
+class MockAzureOpenAI:
+    """Local stand-in for the Azure OpenAI chat/completions endpoint.
+
+    Every request waits latency +/- jitter seconds and is answered with
+    canned_insight_blocks for its prompt and a usage block. A share of
+    requests (error_rate) is refused with 429 and a Retry-After header, the
+    way a throttled deployment answers. Streamed requests ("stream": true)
+    get their first token after first_token_share of the delay and the rest
+    of the reply as server-sent events spread over the remainder.
+
+    With tokens_per_minute / requests_per_minute set, requests are also
+    counted against a one-minute sliding quota like a deployment's TPM/RPM:
+    replies carry x-ratelimit-remaining-* headers and a request over quota
+    gets a 429 with the Retry-After until enough of the window has expired.
+    A share of requests (server_error_rate) fails with 503, like a deployment
+    that is down or overloaded, and another (slow_share) takes slow_seconds
+    longer to start answering, the stragglers behind tail latency.
+    """
+
+    def __init__(self, latency=1.0, jitter=0.25, error_rate=0.0, retry_after=1, host="127.0.0.1", port=0, seed=0,
+                 first_token_share=0.2, tokens_per_minute=None, requests_per_minute=None, server_error_rate=0.0,
+                 slow_share=0.0, slow_seconds=10.0):
+        self.latency = latency
+        self.server_error_rate = server_error_rate
+        self.slow_share = slow_share
+        self.slow_seconds = slow_seconds
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        # (time, tokens) of the requests admitted in the last minute
+        self.window = deque()
+        self.first_token_share = first_token_share
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "throttled": 0, "over_quota": 0, "server_errors": 0, "slow": 0, "completed": 0, "prompt_tokens": 0,
+                      "completion_tokens": 0}
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def _admit(self, cost):
+        # Called with the lock held; returns (quota headers, seconds to wait or None when admitted)
+        if not self.tokens_per_minute and not self.requests_per_minute:
+            return {}, None
+        now = time.time()
+        while self.window and self.window[0][0] <= now - 60:
+            self.window.popleft()
+        used_tokens = sum(tokens for _, tokens in self.window)
+        over = ((self.tokens_per_minute and used_tokens + cost > self.tokens_per_minute)
+                or (self.requests_per_minute and len(self.window) + 1 > self.requests_per_minute))
+        if not over:
+            self.window.append((now, cost))
+            used_tokens += cost
+        headers = {}
+        if self.tokens_per_minute:
+            headers["x-ratelimit-remaining-tokens"] = str(max(0, self.tokens_per_minute - used_tokens))
+        if self.requests_per_minute:
+            headers["x-ratelimit-remaining-requests"] = str(max(0, self.requests_per_minute - len(self.window)))
+        if not over:
+            return headers, None
+        # Wait for the oldest request still in the window to drop out
+        return headers, max(0.001, self.window[0][0] + 60 - now) if self.window else 0.001
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive connections and chunked event streams, like the real service
+            protocol_version = "HTTP/1.1"
+
+            def handle(self):
+                try:
+                    super().handle()
+                except ConnectionError:
+                    # The client hung up: a cancelled request or an idle keep-alive connection being dropped
+                    pass
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                prompt_text = "\n".join(message["content"] for message in payload["messages"])
+                with mock.lock:
+                    mock.stats["requests"] += 1
+                    server_error = mock.rng.random() < mock.server_error_rate
+                    mock.stats["server_errors"] += server_error
+                if server_error:
+                    self._reply(503, {"error": {"code": "503", "message": "The service is temporarily unavailable."}})
+                    return
+                with mock.lock:
+                    throttled = mock.rng.random() < mock.error_rate
+                    delay = max(0.0, mock.latency + mock.rng.uniform(-mock.jitter, mock.jitter))
+                    slow = mock.rng.random() < mock.slow_share
+                    stall = mock.slow_seconds if slow else 0.0
+                    quota_headers, quota_wait = ({}, None) if throttled else mock._admit((len(prompt_text) + 3) // 4 + payload.get("max_tokens", 0))
+                    mock.stats["throttled"] += throttled or quota_wait is not None
+                    mock.stats["over_quota"] += quota_wait is not None
+                    mock.stats["slow"] += slow and not throttled and quota_wait is None
+                if throttled or quota_wait is not None:
+                    retry_after = mock.retry_after if throttled else quota_wait
+                    self._reply(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                                dict(quota_headers, **{"Retry-After": str(int(-(-retry_after // 1))),
+                                                       "retry-after-ms": str(int(retry_after * 1000))}))
+                    return
+                reply = "\n".join(canned_insight_blocks(payload["messages"][-1]["content"]))
+                usage = {"prompt_tokens": (len(prompt_text) + 3) // 4, "completion_tokens": (len(reply) + 3) // 4}
+                usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+                if payload.get("stream"):
+                    self._stream(reply, usage, delay, quota_headers, stall)
+                else:
+                    time.sleep(delay + stall)
+                    self._reply(200, {"choices": [{"message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                                      "usage": usage}, quota_headers)
+                with mock.lock:
+                    mock.stats["completed"] += 1
+                    mock.stats["prompt_tokens"] += usage["prompt_tokens"]
+                    mock.stats["completion_tokens"] += usage["completion_tokens"]
+
+            def _stream(self, reply, usage, delay, quota_headers, stall=0.0):
+                time.sleep(delay * mock.first_token_share + stall)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                for name, value in quota_headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                # One event per ~4 characters (about a token), written in 20 timed bursts
+                tokens = [reply[position:position + 4] for position in range(0, len(reply), 4)]
+                burst = max(1, -(-len(tokens) // 20))
+                for position in range(0, len(tokens), burst):
+                    events = [{"choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                              for token in tokens[position:position + burst]]
+                    self._write_chunk("".join(f"data: {json.dumps(event)}\n\n" for event in events))
+                    time.sleep(delay * (1 - mock.first_token_share) * burst / max(len(tokens), 1))
+                self._write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\ndata: [DONE]\n\n")
+                self._write_chunk("")
+
+            def _write_chunk(self, text):
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def _reply(self, status, body, extra_headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (extra_headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def benchmark_pipeline(sections=40, subsections=5, bullets=4, pdf_path=None, latency=1.0, jitter=0.25, error_rate=0.0,
+                       retry_after=1, workers=8, backend="pdfplumber", extraction_workers=1, use_cache=False,
+                       output_path=None, baseline_path=None, max_regression=0.2, quota_tpm=None, quota_rpm=None, rate_limit=True,
+                       deployments=1, failing_deployment=False, slow_share=0.0, slow_seconds=10.0, hedging=True):
+    """Run extraction -> parsing -> LLM -> Excel end to end against MockAzureOpenAI and report throughput per stage.
+
+    quota_tpm/quota_rpm give each mock deployment a quota. The client-side rate
+    limiters start from a fresh state file and learn the quota from the mock's
+    headers; rate_limit=False leaves 429s to the HTTP retries instead. With
+    several deployments the n-th answers after latency * (1 + n/2), and
+    failing_deployment makes the last one fail every request with 503.
+    slow_share of the requests stall for slow_seconds; hedging=False turns
+    hedged requests off to compare the tail latency without them.
+    Returns False when baseline_path is given and end-to-end time regressed by more than max_regression.
+    """
+    mocks = [MockAzureOpenAI(latency * (1 + number / 2), jitter, error_rate, retry_after, seed=number, tokens_per_minute=quota_tpm,
+                             requests_per_minute=quota_rpm,
+                             server_error_rate=1.0 if failing_deployment and number == deployments - 1 else 0.0,
+                             slow_share=slow_share, slow_seconds=slow_seconds).start()
+             for number in range(max(1, deployments))]
+    previous_pool = None
+    # A fresh policy, so the hedge delay is learned from this run's latencies only
+    previous_policy = openai_service.use_hedge_policy(openai_service.make_hedge_policy() if hedging else None)
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            if pdf_path is None:
+                pdf_path = os.path.join(work_dir, "synthetic_msa.pdf")
+                synthetic_contract_pdf(pdf_path, sections, subsections, bullets)
+            page_count = count_pdf_pages(pdf_path)
+            pool = DeploymentPool(
+                Deployment(mock.endpoint, "mock-key", openai_service.deployment_name, openai_service.api_version, name=f"mock-{number}",
+                           rate_limiter=RateLimiter(f"mock-{number}", os.path.join(work_dir, "rate_limit.json")) if rate_limit else None)
+                for number, mock in enumerate(mocks)
+            )
+            previous_pool = openai_service.use_deployments(pool)
+            tracer = Tracer("benchmark pipeline")
+            usage_before = openai_service.usage_stats()
+            first_row = []
+
+            def row_arrived(index, row):
+                if row and not first_row:
+                    first_row.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with use_tracer(tracer):
+                with trace("stream_insights", "pipeline"):
+                    pages = iter_pages_from_pdf(pdf_path, workers=extraction_workers, backend=backend)
+                    _, rows, _ = stream_insights(pages, max_workers=workers, use_cache=use_cache, row_callback=row_arrived,
+                                                 preview_callback=row_arrived)
+                insight_store = InsightStore(rows)
+                with trace("json_to_excel", "excel", rows=len(insight_store.rows)):
+                    json_to_excel(insight_store.rows, os.path.join(work_dir, "Insights_synthetic_msa.xlsx"))
+            elapsed = time.perf_counter() - start
+            usage_after = openai_service.usage_stats()
+            hedges = openai_service.hedge_stats()
+    finally:
+        openai_service.use_hedge_policy(previous_policy)
+        if previous_pool is not None:
+            openai_service.use_deployments(previous_pool)
+        for mock in mocks:
+            mock.stop()
+
+    tokens = usage_after["total_tokens"] - usage_before["total_tokens"]
+    request_seconds = sorted(span["duration"] for span in tracer.spans if span["name"] == "chat completion")
+    results = {
+        "pages": page_count,
+        "subsections": len(rows),
+        "rows": len(insight_store.rows),
+        "requests": sum(mock.stats["requests"] for mock in mocks),
+        "throttled": sum(mock.stats["throttled"] for mock in mocks),
+        "over_quota": sum(mock.stats["over_quota"] for mock in mocks),
+        "server_errors": sum(mock.stats["server_errors"] for mock in mocks),
+        "slow_requests": sum(mock.stats["slow"] for mock in mocks),
+        "hedges": hedges["hedges"] if hedges else 0,
+        "hedge_wins": hedges["hedge_wins"] if hedges else 0,
+        "p50_request_seconds": round(request_seconds[len(request_seconds) // 2], 3) if request_seconds else None,
+        "p99_request_seconds": round(request_seconds[min(len(request_seconds) - 1, int(len(request_seconds) * 0.99))], 3)
+                               if request_seconds else None,
+        "rate_limit_wait_seconds": round(sum(span["args"].get("rate_limit_wait_seconds") or 0 for span in tracer.spans), 2),
+        "elapsed_seconds": round(elapsed, 3),
+        "pages_per_second": round(page_count / elapsed, 2),
+        "subsections_per_second": round(len(rows) / elapsed, 2),
+        "tokens_per_minute": round(tokens / elapsed * 60),
+        "first_row_seconds": round(first_row[0], 3) if first_row else None,
+        "mean_ttft_seconds": next((round(row["mean_ttft_s"], 3) for row in tracer.summary()
+                                   if row["category"] == "llm" and row["mean_ttft_s"] is not None), None),
+        "deployments": pool.health(),
+        "stages": {row["stage"]: {"calls": row["calls"], "total_s": round(row["total_s"], 3), "mean_s": round(row["mean_s"], 4)}
+                   for row in tracer.summary()}
+    }
+
+    print(f"{page_count} pages, {len(rows)} subsections ({results['rows']} rows) in {elapsed:.2f}s: "
+          f"{results['pages_per_second']} pages/s, {results['subsections_per_second']} subsections/s, "
+          f"{results['tokens_per_minute']} tokens/min, {results['requests']} requests ({results['throttled']} throttled, "
+          f"{results['over_quota']} over quota, {results['server_errors']} server errors), "
+          f"{results['rate_limit_wait_seconds']}s waited for the rate limit")
+    print(f"Requests p50 {results['p50_request_seconds']}s, p99 {results['p99_request_seconds']}s; {results['slow_requests']} stalled, "
+          f"{results['hedges']} hedged ({results['hedge_wins']} hedges won)")
+    if results["mean_ttft_seconds"] is not None:
+        print(f"First row after {results['first_row_seconds']}s, mean time to first token {results['mean_ttft_seconds']}s")
+    else:
+        print(f"First row after {results['first_row_seconds']}s")
+    print(f"{'stage':<24}{'calls':>8}{'total s':>10}{'mean ms':>10}{'per s':>10}")
+    for stage, figures in results["stages"].items():
+        per_second = figures["calls"] / figures["total_s"] if figures["total_s"] else float("inf")
+        print(f"{stage:<24}{figures['calls']:>8}{figures['total_s']:>10.3f}{figures['mean_s'] * 1000:>10.1f}{per_second:>10.1f}")
+    if len(results["deployments"]) > 1:
+        print(f"{'deployment':<24}{'requests':>10}{'failures':>10}{'throttled':>10}{'latency ms':>12}")
+        for health in results["deployments"]:
+            print(f"{health['deployment']:<24}{health['requests']:>10}{health['failures']:>10}{health['throttled']:>10}"
+                  f"{str(health['latency_ms']):>12}")
+
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+    if baseline_path:
+        with open(baseline_path, "r", encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        change = elapsed / baseline["elapsed_seconds"] - 1
+        print(f"End to end {change:+.1%} against {baseline_path} ({baseline['elapsed_seconds']}s)")
+        if change > max_regression:
+            print(f"REGRESSION: more than {max_regression:.0%} slower than the baseline")
+            return False
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Contract Insights performance benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backends_parser = subparsers.add_parser("backends", help="Compare PDF text extraction backends")
+    backends_parser.add_argument("pdf", help="Path to a contract PDF")
+    backends_parser.add_argument("--runs", type=int, default=1, help="Timed runs per backend (best is reported)")
+    backends_parser.add_argument("--workers", type=int, default=1, help="Extraction worker processes")
+
+    parser_parser = subparsers.add_parser("parser", help="Benchmark the single-pass structure parser on a synthetic contract")
+    parser_parser.add_argument("--sections", type=int, default=300, help="Number of top-level sections to generate")
+    parser_parser.add_argument("--runs", type=int, default=3, help="Timed runs (best is reported)")
+
+    excel_parser = subparsers.add_parser("excel", help="Benchmark the single-pass Excel writer against to_excel + formatting_excel")
+    excel_parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 50000], help="Row counts to benchmark")
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="End-to-end run on a synthetic contract against a local mock Azure OpenAI endpoint")
+    pipeline_parser.add_argument("--pdf", help="Use this PDF instead of generating a synthetic contract")
+    pipeline_parser.add_argument("--sections", type=int, default=40, help="Top-level sections in the synthetic contract")
+    pipeline_parser.add_argument("--subsections", type=int, default=5, help="Subsections per section")
+    pipeline_parser.add_argument("--bullets", type=int, default=4, help="Bullets per subsection")
+    pipeline_parser.add_argument("--latency", type=float, default=1.0, help="Mock response time in seconds")
+    pipeline_parser.add_argument("--jitter", type=float, default=0.25, help="Random +/- seconds added to the latency")
+    pipeline_parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    pipeline_parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with each 429")
+    pipeline_parser.add_argument("--workers", type=int, default=8, help="LLM requests in flight")
+    pipeline_parser.add_argument("--backend", choices=list(EXTRACTION_BACKENDS), default="pdfplumber")
+    pipeline_parser.add_argument("--extraction-workers", type=int, default=1, help="Extraction worker processes")
+    pipeline_parser.add_argument("--use-cache", action="store_true", help="Let the response cache answer repeated prompts")
+    pipeline_parser.add_argument("--output", help="Write the results as JSON (e.g. to use as a later --baseline)")
+    pipeline_parser.add_argument("--baseline", help="Results JSON of an earlier run to compare against")
+    pipeline_parser.add_argument("--max-regression", type=float, default=0.2, help="Fail when end to end is this much slower than the baseline")
+    pipeline_parser.add_argument("--quota-tpm", type=int, help="Tokens per minute the mock deployment accepts")
+    pipeline_parser.add_argument("--quota-rpm", type=int, help="Requests per minute the mock deployment accepts")
+    pipeline_parser.add_argument("--no-rate-limit", action="store_true", help="Turn the client-side rate limiter off")
+    pipeline_parser.add_argument("--deployments", type=int, default=1, help="Mock deployments to balance over (each slower than the last)")
+    pipeline_parser.add_argument("--failing-deployment", action="store_true", help="Make the last mock deployment answer every request with 503")
+    pipeline_parser.add_argument("--slow-share", type=float, default=0.0, help="Share of requests the mock stalls before answering")
+    pipeline_parser.add_argument("--slow-seconds", type=float, default=10.0, help="How long a stalled request waits")
+    pipeline_parser.add_argument("--no-hedging", action="store_true", help="Never send a second copy of a slow request")
+
+    mock_parser = subparsers.add_parser("mock-server", help="Serve the mock Azure OpenAI endpoint (point openai_endpoint at it)")
+    mock_parser.add_argument("--port", type=int, default=8000)
+    mock_parser.add_argument("--latency", type=float, default=1.0, help="Response time in seconds")
+    mock_parser.add_argument("--jitter", type=float, default=0.25, help="Random +/- seconds added to the latency")
+    mock_parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    mock_parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with each 429")
+    mock_parser.add_argument("--quota-tpm", type=int, help="Tokens per minute the mock deployment accepts")
+    mock_parser.add_argument("--quota-rpm", type=int, help="Requests per minute the mock deployment accepts")
+    mock_parser.add_argument("--server-error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    mock_parser.add_argument("--slow-share", type=float, default=0.0, help="Share of requests stalled before answering")
+    mock_parser.add_argument("--slow-seconds", type=float, default=10.0, help="How long a stalled request waits")
+
+    pdf_parser = subparsers.add_parser("synthetic-pdf", help="Write a synthetic MSA-style contract PDF")
+    pdf_parser.add_argument("path", help="Output PDF path")
+    pdf_parser.add_argument("--sections", type=int, default=40)
+    pdf_parser.add_argument("--subsections", type=int, default=5)
+    pdf_parser.add_argument("--bullets", type=int, default=4)
+
+    args = parser.parse_args()
+    if args.command == "backends":
+        compare_backends(args.pdf, runs=args.runs, workers=args.workers)
+    elif args.command == "parser":
+        benchmark_parser(sections=args.sections, runs=args.runs)
+    elif args.command == "excel":
+        benchmark_excel(args.rows)
+    elif args.command == "pipeline":
+        passed = benchmark_pipeline(args.sections, args.subsections, args.bullets, args.pdf, args.latency, args.jitter,
+                                    args.error_rate, args.retry_after, args.workers, args.backend, args.extraction_workers,
+                                    args.use_cache, args.output, args.baseline, args.max_regression, args.quota_tpm, args.quota_rpm,
+                                    not args.no_rate_limit, args.deployments, args.failing_deployment, args.slow_share,
+                                    args.slow_seconds, not args.no_hedging)
+        sys.exit(0 if passed else 1)
+    elif args.command == "mock-server":
+        mock = MockAzureOpenAI(args.latency, args.jitter, args.error_rate, args.retry_after, port=args.port,
+                               tokens_per_minute=args.quota_tpm, requests_per_minute=args.quota_rpm,
+                               server_error_rate=args.server_error_rate, slow_share=args.slow_share,
+                               slow_seconds=args.slow_seconds)
+        print(f"Mock Azure OpenAI endpoint at {mock.endpoint} (Ctrl+C to stop)")
+        try:
+            mock.server.serve_forever()
+        except KeyboardInterrupt:
+            print(mock.stats)
+    elif args.command == "synthetic-pdf":
+        pages = synthetic_contract_pdf(args.path, args.sections, args.subsections, args.bullets)
+        print(f"Wrote {pages} pages to {args.path}")
+
+if __name__ == "__main__":
+    main()
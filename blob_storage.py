@@ -1,13 +1,212 @@
-from azure.storage.blob import ContainerClient
-from io import BytesIO
-
-def download_pdf_from_blob(connection_string, container_name, blob_name):
-    # Connect to the Blob Service
-    blob_service_client = ContainerClient.from_connection_string(connection_string,container_name)
-    blob_client = blob_service_client.get_blob_client( blob=blob_name)
-    
-    # Download the blob to an in-memory bytes buffer
-    pdf_data = BytesIO()
-    pdf_data.write(blob_client.download_blob().readall())
-    pdf_data.seek(0)  # Reset buffer to the beginning
-    return pdf_data
\ No newline at end of file
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
+from azure.storage.blob import BlobServiceClient
+from io import BytesIO, RawIOBase
+import functools
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+import yaml
+from rate_limiter import file_lock
+
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file)
+
+# Local copies of downloaded blobs, revalidated against Azure with the stored ETag
+blob_cache_dir = config.get("blob_cache", {}).get("directory", os.path.join("Insights", "blob_cache"))
+blob_cache_max_bytes = int(config.get("blob_cache", {}).get("max_size_mb", 2048) * 1024 * 1024)
+
+# Large blobs are fetched as parallel ranged GETs written straight into the cache file
+download_concurrency = config.get("blob_download", {}).get("max_concurrency", 4)
+download_chunk_bytes = int(config.get("blob_download", {}).get("chunk_size_mb", 4) * 1024 * 1024)
+download_single_get_bytes = int(config.get("blob_download", {}).get("single_get_size_mb", 8) * 1024 * 1024)
+
+_blob_locks = {}
+_blob_locks_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def get_blob_service_client(connection_string):
+    # One client per connection string for the whole process; it is thread-safe and reuses its connections
+    return BlobServiceClient.from_connection_string(
+        connection_string,
+        max_single_get_size=download_single_get_bytes,
+        max_chunk_get_size=download_chunk_bytes
+    )
+
+def _blob_lock(cache_key):
+    with _blob_locks_lock:
+        return _blob_locks.setdefault(cache_key, threading.Lock())
+
+def _cache_paths(account_host, container_name, blob_name):
+    # The account's host (e.g. acct.blob.core.windows.net) keeps equally named blobs of different accounts apart
+    cache_key = hashlib.sha256(f"{account_host}/{container_name}/{blob_name}".encode("utf-8")).hexdigest()
+    return cache_key, os.path.join(blob_cache_dir, f"{cache_key}.blob"), os.path.join(blob_cache_dir, f"{cache_key}.json")
+
+def _evict_blob_cache(keep_path):
+    # Least recently used first (hits refresh the mtime) until the cache fits in its size limit
+    entries = []
+    for name in os.listdir(blob_cache_dir):
+        if name.endswith(".blob"):
+            path = os.path.join(blob_cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= blob_cache_max_bytes:
+            break
+        if path == keep_path:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # Still open in another session (Windows refuses to delete a mapped file): try it next time
+            continue
+        try:
+            os.remove(path[:-len(".blob")] + ".json")
+        except OSError:
+            pass
+        total_size -= size
+
+def list_container_names(connection_string):
+    return [container.name for container in get_blob_service_client(connection_string).list_containers()]
+
+def list_pdf_blobs(connection_string, container_name, prefix="", max_results=500, page_size=500):
+    """List up to max_results PDF blobs whose name starts with prefix, with their size, last-modified time and ETag.
+
+    The prefix is matched by Azure (name_starts_with) and result pages are only
+    fetched until max_results PDFs have been found.
+    """
+    container_client = get_blob_service_client(connection_string).get_container_client(container_name)
+    blobs = []
+    for blob in container_client.list_blobs(name_starts_with=prefix or None, results_per_page=page_size):
+        if blob.name.endswith(".pdf"):
+            blobs.append({
+                "name": blob.name,
+                "size": blob.size,
+                "last_modified": blob.last_modified,
+                "etag": blob.etag
+            })
+            if len(blobs) >= max_results:
+                break
+    return blobs
+
+def download_blob_to_cache(connection_string, container_name, blob_name, known_etag=None):
+    """Return the path of an up-to-date local copy of the blob.
+
+    A cached copy is revalidated with a conditional If-None-Match request on its
+    ETag, so an unchanged blob costs one round trip and no download. When the
+    caller already knows the current ETag (e.g. from a recent listing) and it
+    matches the cached copy, no request is made at all.
+    """
+    service_client = get_blob_service_client(connection_string)
+    cache_key, data_path, meta_path = _cache_paths(service_client.primary_hostname, container_name, blob_name)
+    blob_client = service_client.get_blob_client(container_name, blob_name)
+
+    if not os.path.exists(blob_cache_dir):
+        os.makedirs(blob_cache_dir, exist_ok=True)
+    # Streamlit sessions and batch runs share the cache directory: the file lock keeps one process's
+    # metadata from ending up next to another process's download of the same blob
+    with _blob_lock(cache_key), file_lock(os.path.join(blob_cache_dir, f"{cache_key}.lock")):
+        metadata = None
+        if os.path.exists(data_path) and os.path.exists(meta_path):
+            try:
+                with open(meta_path, "r") as meta_file:
+                    metadata = json.load(meta_file)
+            except (OSError, ValueError):
+                # Unreadable metadata (e.g. from an older, non-atomic write): download the blob again
+                metadata = None
+
+        if metadata and known_etag and metadata["etag"] == known_etag:
+            os.utime(data_path)
+            return data_path
+
+        try:
+            if metadata:
+                downloader = blob_client.download_blob(etag=metadata["etag"], match_condition=MatchConditions.IfModified,
+                                                       max_concurrency=download_concurrency)
+            else:
+                downloader = blob_client.download_blob(max_concurrency=download_concurrency)
+        except ResourceNotModifiedError:
+            os.utime(data_path)
+            return data_path
+
+        # Ranges are written at their offsets as they arrive, so memory stays at about
+        # chunk size x concurrency whatever the blob size. The file is written next to
+        # the final path and swapped in, so readers never see a partial file.
+        with tempfile.NamedTemporaryFile(dir=blob_cache_dir, suffix=".part", delete=False) as temp_file:
+            downloader.readinto(temp_file)
+        os.replace(temp_file.name, data_path)
+
+        properties = downloader.properties
+        with tempfile.NamedTemporaryFile("w", dir=blob_cache_dir, suffix=".part", delete=False) as meta_file:
+            json.dump({
+                "container": container_name,
+                "blob": blob_name,
+                "etag": properties.etag,
+                "last_modified": properties.last_modified.isoformat() if properties.last_modified else None,
+                "size": properties.size
+            }, meta_file)
+        os.replace(meta_file.name, meta_path)
+
+        _evict_blob_cache(data_path)
+        return data_path
+
+class MappedBlob(RawIOBase):
+    """Read-only binary file object over a memory-mapped cached blob.
+
+    Reads are served from the OS page cache instead of a private copy in
+    Python memory, and name points at the file on disk so libraries that
+    prefer a path (PyMuPDF, the extraction process pool) can reopen it.
+    """
+
+    def __init__(self, path):
+        self.name = path
+        with open(path, "rb") as blob_file:
+            if os.fstat(blob_file.fileno()).st_size:
+                self._map = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # An empty file can't be mapped; it reads as empty, so the PDF libraries report it as not a PDF
+                self._map = BytesIO()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._map.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        return self._map.read(None if size is None or size < 0 else size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._map.seek(offset, whence)
+        return self._map.tell()
+
+    def tell(self):
+        return self._map.tell()
+
+    def getbuffer(self):
+        # Zero-copy view of the whole file
+        return self._map.getbuffer() if isinstance(self._map, BytesIO) else memoryview(self._map)
+
+    def close(self):
+        if not self.closed:
+            self._map.close()
+        super().close()
+
+def open_pdf_from_blob(connection_string, container_name, blob_name, known_etag=None):
+    """Bring the blob cache up to date and return a memory-mapped view of the PDF."""
+    return MappedBlob(download_blob_to_cache(connection_string, container_name, blob_name, known_etag))
@@ -0,0 +1,100 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+# Latency and error rate are exponentially weighted moving averages with this weight for the newest reply
+EWMA_ALPHA = 0.2
+# A deployment that fails (5xx, connection error) is left alone for 2, 4, 8... seconds, at most MAX_COOLDOWN
+MAX_COOLDOWN = 60
+
+class Deployment:
+    """One Azure OpenAI deployment requests can be routed to, with its own rate limit and health figures."""
+
+    def __init__(self, endpoint, api_key, deployment_name, api_version, weight=1.0, name=None, rate_limiter=None):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.deployment_name = deployment_name
+        self.api_version = api_version
+        self.weight = weight
+        self.name = name or f"{urlparse(endpoint).netloc or endpoint}/{deployment_name}"
+        self.api_url = f"{endpoint}openai/deployments/{deployment_name}/chat/completions?api-version={api_version}"
+        self.rate_limiter = rate_limiter
+        self.lock = threading.Lock()
+        self.requests = self.failures = self.throttled = self.consecutive_failures = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.cooling_until = 0.0
+
+    def record(self, status_code=None, latency=None, retry_after=None):
+        """Account for one reply (status_code None: the connection failed) and its time to the response headers."""
+        with self.lock:
+            self.requests += 1
+            failed = status_code is None or status_code == 429 or status_code >= 500
+            self.error_rate += EWMA_ALPHA * (failed - self.error_rate)
+            if latency is not None and not failed:
+                self.latency = latency if self.latency is None else self.latency + EWMA_ALPHA * (latency - self.latency)
+            if status_code == 429:
+                # Throttling says nothing about the deployment's health, only that its quota is used up for now
+                self.throttled += 1
+                self.cooling_until = max(self.cooling_until, time.time() + (retry_after or 1.0))
+            elif failed:
+                self.failures += 1
+                self.consecutive_failures += 1
+                self.cooling_until = time.time() + min(MAX_COOLDOWN, 2 ** self.consecutive_failures)
+            else:
+                self.consecutive_failures = 0
+
+    def score(self, default_latency):
+        # Share of traffic: proportional to the weight, inversely to the latency, and shrinking with recent errors
+        with self.lock:
+            latency = self.latency if self.latency is not None else default_latency
+            return max(1e-6, self.weight / max(latency, 0.01) * (1 - self.error_rate) ** 2)
+
+    def health(self):
+        with self.lock:
+            return {
+                "deployment": self.name,
+                "weight": self.weight,
+                "requests": self.requests,
+                "failures": self.failures,
+                "throttled": self.throttled,
+                "latency_ms": round(self.latency * 1000) if self.latency is not None else None,
+                "error_rate": round(self.error_rate, 3),
+                "cooling_seconds": round(max(0.0, self.cooling_until - time.time()), 1)
+            }
+
+class DeploymentPool:
+    """Route requests over several deployments of the same model so their quotas add up.
+
+    choose() skips deployments that are cooling down after a failure or a 429
+    and prefers those whose rate limit lets the request out straight away;
+    among those the pick is random, weighted by Deployment.score. Passing the
+    deployments already tried as exclude gives the failover order for one request.
+    """
+
+    def __init__(self, deployments):
+        self.deployments = list(deployments)
+        self.rng = random.Random()
+
+    def __len__(self):
+        return len(self.deployments)
+
+    def choose(self, cost=0, exclude=()):
+        candidates = [deployment for deployment in self.deployments if deployment.name not in exclude] or self.deployments
+        now = time.time()
+        healthy = ([deployment for deployment in candidates if deployment.cooling_until <= now]
+                   or [min(candidates, key=lambda deployment: deployment.cooling_until)])
+        if len(healthy) == 1:
+            return healthy[0]
+        delays = [deployment.rate_limiter.delay(cost) if deployment.rate_limiter else 0.0 for deployment in healthy]
+        ready = [deployment for deployment, delay in zip(healthy, delays) if delay <= min(delays)]
+        latencies = [deployment.latency for deployment in self.deployments if deployment.latency is not None]
+        default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+        return self.rng.choices(ready, weights=[deployment.score(default_latency) for deployment in ready])[0]
+
+    def has_untried(self, tried):
+        return any(deployment.name not in tried for deployment in self.deployments)
+
+    def health(self):
+        return [deployment.health() for deployment in self.deployments]
@@ -0,0 +1,66 @@
+import threading
+from collections import deque
+
+class HedgePolicy:
+    """When a slow request gets a duplicate ("hedge") and how often that is allowed.
+
+    The hedge delay is the percentile-th percentile of the latencies of the
+    last window requests (time until the reply starts arriving), never less
+    than min_delay; until min_samples latencies are known nothing is hedged.
+    Every request adds max_rate to a credit that each hedge spends one of,
+    so at most about max_rate of the requests are sent twice (plus up to
+    burst hedges after a quiet spell).
+    """
+
+    def __init__(self, percentile=95, window=200, min_samples=20, min_delay=1.0, max_rate=0.05, burst=2):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_rate = max_rate
+        self.burst = burst
+        self.latencies = deque(maxlen=window)
+        self.credit = float(burst)
+        self.lock = threading.Lock()
+        self.requests = self.hedges = self.hedge_wins = 0
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def delay(self):
+        """Seconds after which a request still without a reply is hedged; None while too few latencies are known."""
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[index])
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+            self.credit = min(self.burst, self.credit + self.max_rate)
+
+    def try_hedge(self):
+        """Spend one hedge from the budget; False when the hedge rate is used up."""
+        with self.lock:
+            if self.credit < 1:
+                return False
+            self.credit -= 1
+            self.hedges += 1
+            return True
+
+    def hedge_won(self):
+        with self.lock:
+            self.hedge_wins += 1
+
+    def stats(self):
+        delay = self.delay()
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": round(self.hedges / self.requests, 3) if self.requests else 0.0,
+                "hedge_delay_seconds": round(delay, 3) if delay is not None else None
+            }
@@ -0,0 +1,497 @@
+import contextvars
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from openai_service import RequestCancelled, discard_cached_response, send_to_openai, estimate_tokens
+from pdf_processing import JsonBlockStream, StructureParser, parse_json_blocks
+from tracing import trace
+from utils import insights_dataframe
+
+# Clause text beyond this many characters is moved into the "Notes" column
+CLAUSE_CHAR_LIMIT = 1000
+
+# Subsection text packed into a single request is kept under this many tokens so
+# the JSON the model writes back still fits in max_tokens
+REQUEST_TOKEN_BUDGET = 1800
+MAX_SUBSECTIONS_PER_REQUEST = 8
+
+# Model calls per subsection at most, a packed request counting as the first: a subsection whose reply is
+# missing or unparseable is re-sent on its own until then; JSON_REPAIR lets lenient parsing fix trailing commas, Python literals and truncated replies
+MAX_ATTEMPTS = 3
+JSON_REPAIR = True
+
+def make_unit(section, subsection, details):
+    # Text before a section's first subsection is sent under the section's own name
+    if subsection == "No Subsection":
+        subsection = section
+    return (section, subsection, details)
+
+def build_subsection_units(content):
+    """Flatten the parsed section/subsection tree into (section, subsection, bullets) units, in document order."""
+    units = []
+    for section, subsections in content.items():
+        if isinstance(subsections, dict):
+            for subsection, details in subsections.items():
+                if details:
+                    units.append(make_unit(section, subsection, details))
+    return units
+
+def unit_key(unit):
+    # Identifies a subsection independently of how many units the extraction produced around it
+    return unit[0], unit[1]
+
+def select_section_units(content, sections, skip=()):
+    """Units of the subsections of the chosen sections, in document order.
+
+    Units whose unit_key is in skip (e.g. subsections that already have a row)
+    are left out.
+    """
+    sections = set(sections)
+    return [unit for unit in build_subsection_units(content) if unit[0] in sections and unit_key(unit) not in skip]
+
+def format_subsection_prompt(section, subsection, bullets):
+    bullet_points = "\n".join(f"- {item}" for item in bullets)
+    return f"section_name: {section}\nsubsection_name:{subsection}\nbulletpoints:\n{bullet_points}\n"
+
+class RequestPlanner:
+    """Group subsection units into LLM requests as they arrive.
+
+    Each request is a list of (unit_index, bullets) pieces. Consecutive small
+    subsections are packed together up to token_budget, and a subsection larger
+    than the budget is split at bullet boundaries into requests of its own.
+    """
+
+    def __init__(self, token_budget=REQUEST_TOKEN_BUDGET, max_subsections=MAX_SUBSECTIONS_PER_REQUEST):
+        self.token_budget = token_budget
+        self.max_subsections = max_subsections
+        self.current = []
+        self.current_tokens = 0
+
+    def flush(self):
+        """Return the partly filled request, if any, as a list of ready requests."""
+        ready = [self.current] if self.current else []
+        self.current, self.current_tokens = [], 0
+        return ready
+
+    def add(self, index, unit):
+        """Plan one unit and return the requests that are now ready to send."""
+        section, subsection, details = unit
+        unit_tokens = estimate_tokens(format_subsection_prompt(section, subsection, details))
+        if unit_tokens > self.token_budget:
+            ready = self.flush()
+            chunk, chunk_tokens = [], 0
+            for bullet in details:
+                bullet_tokens = estimate_tokens(bullet)
+                if chunk and chunk_tokens + bullet_tokens > self.token_budget:
+                    ready.append([(index, chunk)])
+                    chunk, chunk_tokens = [], 0
+                chunk.append(bullet)
+                chunk_tokens += bullet_tokens
+            if chunk:
+                ready.append([(index, chunk)])
+            return ready
+
+        ready = []
+        if self.current and (self.current_tokens + unit_tokens > self.token_budget or len(self.current) >= self.max_subsections):
+            ready = self.flush()
+        self.current.append((index, details))
+        self.current_tokens += unit_tokens
+        return ready
+
+def plan_requests(units, token_budget=REQUEST_TOKEN_BUDGET, max_subsections=MAX_SUBSECTIONS_PER_REQUEST):
+    """Plan all units up front, see RequestPlanner."""
+    planner = RequestPlanner(token_budget, max_subsections)
+    requests = []
+    for index, unit in enumerate(units):
+        requests.extend(planner.add(index, unit))
+    requests.extend(planner.flush())
+    return requests
+
+def build_request_prompt(units, pieces):
+    if len(pieces) == 1:
+        index, bullets = pieces[0]
+        section, subsection, _ = units[index]
+        return format_subsection_prompt(section, subsection, bullets)
+
+    prompt = (f"The text below contains {len(pieces)} separate subsections. Return exactly one JSON block per "
+              f"subsection, in the same order, and add a \"Block\" field to each block holding the subsection number.\n")
+    for number, (index, bullets) in enumerate(pieces, start=1):
+        section, subsection, _ = units[index]
+        prompt += f"\n### Subsection {number}\n" + format_subsection_prompt(section, subsection, bullets)
+    return prompt
+
+def _heading_key(text):
+    return " ".join(str(text).split()).lower()
+
+def match_block_to_piece(block, units, pieces, taken=()):
+    """Slot of the piece the block answers, judged by the subsection header echoed at the start of its Clause Text.
+
+    None when no piece outside taken matches.
+    """
+    clause_text = block.get("Clause Text")
+    if isinstance(clause_text, list):
+        clause_text = clause_text[0] if clause_text else ""
+    header = _heading_key(clause_text or "")
+    if not header:
+        return None
+    names = [(slot, _heading_key(units[index][1])) for slot, (index, _) in enumerate(pieces) if slot not in taken]
+    for slot, name in names:
+        if header.startswith(name):
+            return slot
+    # The model may reword the title but keeps the number (e.g. "1.2")
+    number = header.split(" ", 1)[0]
+    if re.fullmatch(r"\d+(\.\d+)*\.?", number):
+        for slot, name in names:
+            if name.split(" ", 1)[0] == number:
+                return slot
+    return None
+
+def split_clause_text(data, char_limit=CLAUSE_CHAR_LIMIT):
+    """Keep clause text within char_limit and move the overflow into "Notes"."""
+    clause_text_lines = data.get("Clause Text", [])
+    if not isinstance(clause_text_lines, list):
+        clause_text_lines = [clause_text_lines]
+
+    new_clause_text = []
+    notes_text = ""
+    current_length = 0
+    for line in clause_text_lines:
+        line_length = len(line)
+        if current_length + line_length <= char_limit:
+            new_clause_text.append(line)
+            current_length += line_length
+        else:
+            notes_text += line + " "
+
+    data["Clause Text"] = new_clause_text
+    data["Notes"] = notes_text.strip()
+    return data
+
+def process_subsection(prompt_text, use_cache=True, cancel_event=None, max_attempts=MAX_ATTEMPTS, repair=JSON_REPAIR):
+    """Send one subsection prompt on its own until it yields an insight block, at most max_attempts times.
+
+    Returns (block or None, attempts, error). A reply that can't be parsed is
+    dropped from the response cache before the next attempt, so only good
+    replies are ever replayed.
+    """
+    error = None
+    for attempt in range(1, max(1, max_attempts) + 1):
+        try:
+            response = send_to_openai(prompt_text, use_cache=use_cache, cancel_event=cancel_event)
+        except RequestCancelled:
+            raise
+        except Exception as e:
+            response, error = None, f"request failed: {e}"
+        else:
+            error = None if response else "no reply from the model"
+        if response:
+            blocks, errors = parse_json_blocks(response, repair)
+            if blocks:
+                # A subsection the model split over several blocks is put back together
+                return merge_parts(blocks), attempt, None
+            error = f"unparseable reply: {errors[0] if errors else 'no JSON block'}"
+            discard_cached_response(prompt_text)
+    return None, max(1, max_attempts), error
+
+def process_request(units, pieces, use_cache=True, cancel_event=None, max_attempts=MAX_ATTEMPTS, repair=JSON_REPAIR,
+                    block_callback=None):
+    """Send one planned request and map the reply back to its pieces.
+
+    Returns one (block or None, attempts, error) per piece. Subsections of a
+    packed request that the model left out or answered with broken JSON are
+    retried on their own (see process_subsection); one bad subsection never
+    affects the others; the packed request counts as their first of
+    max_attempts. While a packed reply streams in, block_callback(slot, block)
+    is called from this thread for every block as soon as it is complete.
+    """
+    with trace("subsection request", "subsection", subsections=[units[index][1] for index, _ in pieces]):
+        if len(pieces) == 1:
+            return [process_subsection(build_request_prompt(units, pieces), use_cache, cancel_event, max_attempts, repair)]
+
+        results = [None] * len(pieces)
+        on_delta = None
+        if block_callback:
+            block_stream = JsonBlockStream(repair)
+
+            def on_delta(text):
+                for block in block_stream.feed(text):
+                    number = block.get("Block")
+                    slot = number - 1 if isinstance(number, int) else match_block_to_piece(block, units, pieces)
+                    if slot is not None and 0 <= slot < len(pieces):
+                        block_callback(slot, {key: value for key, value in block.items() if key != "Block"})
+        try:
+            response = send_to_openai(build_request_prompt(units, pieces), use_cache=use_cache, cancel_event=cancel_event,
+                                      on_delta=on_delta)
+        except RequestCancelled:
+            raise
+        except Exception:
+            response = None
+        if response:
+            blocks, _ = parse_json_blocks(response, repair)
+            numbered = all(isinstance(block.get("Block"), int) for block in blocks)
+            taken = set()
+            for position, block in enumerate(blocks):
+                number = block.pop("Block", None)
+                if numbered:
+                    slot = number - 1
+                elif len(blocks) == len(pieces):
+                    slot = position
+                else:
+                    # With a block missing, positions shift; a block whose subsection can't be told is dropped
+                    # and its subsection retried on its own below
+                    slot = match_block_to_piece(block, units, pieces, taken)
+                if slot is not None and 0 <= slot < len(pieces) and results[slot] is None:
+                    results[slot] = (block, 1, None)
+                    taken.add(slot)
+
+        for slot, piece in enumerate(pieces):
+            if results[slot] is None and max_attempts > 1:
+                block, attempts, error = process_subsection(build_request_prompt(units, [piece]), use_cache, cancel_event,
+                                                            max_attempts - 1, repair)
+                # The packed request was the first attempt
+                results[slot] = (block, attempts + 1, error)
+            elif results[slot] is None:
+                results[slot] = (None, 1, "missing from the packed reply" if response else "no reply from the model")
+        return results
+
+def merge_parts(parts):
+    """Combine the blocks of a subsection that was split across requests into one row."""
+    parts = [part for part in parts if part]
+    if not parts:
+        return None
+    data = parts[0]
+    clause_text = data.get("Clause Text", [])
+    if not isinstance(clause_text, list):
+        clause_text = [clause_text]
+    clause_text = list(clause_text)
+    for part in parts[1:]:
+        more_text = part.get("Clause Text", [])
+        if not isinstance(more_text, list):
+            more_text = [more_text]
+        # Each part starts with the same subsection header line
+        if clause_text and more_text and more_text[0] == clause_text[0]:
+            more_text = more_text[1:]
+        clause_text.extend(more_text)
+    data["Clause Text"] = clause_text
+    return data
+
+class InsightPipeline:
+    """Send subsection units to the model as they arrive and collect one insight row per unit.
+
+    Units are packed/split into requests by RequestPlanner and dispatched to
+    executor straight away. poll() and finish() must be called from the thread
+    that adds units; they fire progress_callback(done, total) and
+    row_callback(index, row) there, so it is safe to update Streamlit widgets
+    from the callbacks. Once cancel_event is set, requests still queued are
+    dropped and those in flight raise RequestCancelled.
+
+    Every unit gets its own entry in statuses: "done", or "failed" with the
+    last error once its attempts ran out. A failed unit has no row and does
+    not stop the others.
+
+    preview_callback(index, row), if given, is called from the worker threads
+    with each row of a packed request the moment its block has streamed in,
+    before the request is finished; row_callback later delivers the final row
+    (None if it failed after all) for the same index.
+    """
+
+    def __init__(self, executor, use_cache=True, token_budget=REQUEST_TOKEN_BUDGET, max_subsections=MAX_SUBSECTIONS_PER_REQUEST,
+                 progress_callback=None, row_callback=None, cancel_event=None, max_attempts=MAX_ATTEMPTS, repair=JSON_REPAIR,
+                 preview_callback=None):
+        self.executor = executor
+        self.preview_callback = preview_callback
+        self.use_cache = use_cache
+        self.cancel_event = cancel_event
+        self.max_attempts = max_attempts
+        self.repair = repair
+        self.planner = RequestPlanner(token_budget, max_subsections)
+        self.progress_callback = progress_callback
+        self.row_callback = row_callback
+        self.units = []
+        self.parts = []
+        self.pending_parts = []
+        self.rows = []
+        self.statuses = []
+        self.requests = []
+        self.futures = {}
+        self.done = 0
+
+    def add_unit(self, unit):
+        index = len(self.units)
+        self.units.append(unit)
+        self.parts.append([])
+        self.pending_parts.append(0)
+        self.rows.append(None)
+        self.statuses.append({"section": unit[0], "subsection": unit[1], "status": "pending", "attempts": 0, "error": None})
+        self._submit(self.planner.add(index, unit))
+        return index
+
+    def _submit(self, requests):
+        for pieces in requests:
+            position = len(self.requests)
+            self.requests.append(pieces)
+            for index, _ in pieces:
+                self.pending_parts[index] += 1
+            # Run in a copy of the caller's context so the worker's spans land on the caller's tracer
+            block_callback = None
+            if self.preview_callback:
+                block_callback = lambda slot, block, pieces=pieces: self._preview(pieces, slot, block)
+            self.futures[self.executor.submit(contextvars.copy_context().run, process_request, self.units, pieces,
+                                              self.use_cache, self.cancel_event, self.max_attempts, self.repair,
+                                              block_callback)] = position
+
+    def _preview(self, pieces, slot, block):
+        index, bullets = pieces[slot]
+        # Part of a subsection split over several requests is not a row of its own
+        if len(bullets) == len(self.units[index][2]):
+            try:
+                self.preview_callback(index, split_clause_text(block))
+            except Exception:
+                pass
+
+    def _collect(self, future):
+        position = self.futures.pop(future)
+        pieces = self.requests[position]
+        try:
+            results = future.result()
+        except RequestCancelled:
+            raise
+        except Exception as e:
+            results = [(None, 1, f"request failed: {e}")] * len(pieces)
+
+        for (index, _), (block, attempts, error) in zip(pieces, results):
+            status = self.statuses[index]
+            status["attempts"] += attempts
+            status["error"] = status["error"] or error
+            self.parts[index].append((position, block))
+            self.pending_parts[index] -= 1
+            if self.pending_parts[index] == 0:
+                # Requests finish out of order; put split parts back in document order before merging.
+                # A subsection split over several requests only gets a row when every part came back.
+                parts = [part for _, part in sorted(self.parts[index], key=lambda item: item[0])]
+                row = None
+                if all(parts):
+                    try:
+                        row = split_clause_text(merge_parts(parts))
+                    except Exception as e:
+                        status["error"] = f"unusable insight block: {e}"
+                self.rows[index] = row
+                status["status"] = "done" if row else "failed"
+                if row:
+                    status["error"] = None
+                self.done += 1
+                if self.row_callback:
+                    self.row_callback(index, self.rows[index])
+                if self.progress_callback:
+                    self.progress_callback(self.done, len(self.units))
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            # Requests that have not started yet are never sent
+            for future in self.futures:
+                future.cancel()
+            raise RequestCancelled()
+
+    def poll(self):
+        """Collect whatever requests have finished, without waiting."""
+        self.check_cancelled()
+        for future in [future for future in self.futures if future.done()]:
+            self._collect(future)
+
+    def finish(self):
+        """Send the last partly filled request, wait for everything and return the rows in unit order."""
+        self.check_cancelled()
+        self._submit(self.planner.flush())
+        try:
+            for future in as_completed(list(self.futures)):
+                self._collect(future)
+        except RequestCancelled:
+            self.check_cancelled()
+            raise
+        return self.rows
+
+def generate_insights(units, max_workers=8, progress_callback=None, use_cache=True,
+                      token_budget=REQUEST_TOKEN_BUDGET, max_subsections=MAX_SUBSECTIONS_PER_REQUEST, row_callback=None, cancel_event=None,
+                      max_attempts=MAX_ATTEMPTS, repair=JSON_REPAIR, preview_callback=None):
+    """Generate one insight row per subsection unit with at most max_workers requests in flight.
+
+    Returns the rows in the same order as units (None where the model gave
+    nothing usable) and the matching per-unit statuses. use_cache=False
+    bypasses the on-disk response cache. Setting cancel_event stops the run
+    with RequestCancelled. For preview_callback see InsightPipeline.
+    """
+    if not units:
+        return [], []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pipeline = InsightPipeline(executor, use_cache, token_budget, max_subsections, progress_callback, row_callback, cancel_event,
+                                   max_attempts, repair, preview_callback)
+        for unit in units:
+            pipeline.add_unit(unit)
+        return pipeline.finish(), pipeline.statuses
+
+def stream_insights(pages, max_workers=8, progress_callback=None, use_cache=True,
+                    token_budget=REQUEST_TOKEN_BUDGET, max_subsections=MAX_SUBSECTIONS_PER_REQUEST, row_callback=None, cancel_event=None,
+                    max_attempts=MAX_ATTEMPTS, repair=JSON_REPAIR, preview_callback=None):
+    """Parse page texts as they arrive and send each subsection to the model as soon as it is complete.
+
+    Extraction, parsing and inference overlap: a subsection is dispatched the
+    moment the parser sees the heading that ends it. Returns the parsed content
+    tree, one row per subsection unit of that tree in document order (the same
+    as build_subsection_units + generate_insights on the finished tree) and the
+    matching per-unit statuses (see InsightPipeline).
+    Setting cancel_event stops reading pages and raises RequestCancelled.
+    """
+    parser = StructureParser()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pipeline = InsightPipeline(executor, use_cache, token_budget, max_subsections, progress_callback, row_callback, cancel_event,
+                                   max_attempts, repair, preview_callback)
+        page_iterator = iter(pages)
+        while True:
+            with trace("extract page", "extract"):
+                page_text = next(page_iterator, None)
+            if page_text is None:
+                break
+            with trace("parse page", "parse"):
+                for line in page_text.splitlines():
+                    parser.feed(line)
+            for section, subsection, details in parser.pop_completed():
+                pipeline.add_unit(make_unit(section, subsection, details))
+            pipeline.poll()
+
+        content = parser.close()
+        for section, subsection, details in parser.pop_completed():
+            pipeline.add_unit(make_unit(section, subsection, details))
+        rows = pipeline.finish()
+
+    # A heading that repeats later replaces the earlier subsection in the tree; only keep rows
+    # for the bullet lists that made it into the final tree
+    final_units = [id(details) for _, _, details in build_subsection_units(content)]
+    row_by_details = {id(unit[2]): row for unit, row in zip(pipeline.units, rows)}
+    status_by_details = {id(unit[2]): status for unit, status in zip(pipeline.units, pipeline.statuses)}
+    return content, [row_by_details.get(key) for key in final_units], [status_by_details.get(key) for key in final_units]
+
+class InsightStore:
+    """The insight rows of one document, in document order.
+
+    Feeds the Excel writer and the on-screen preview directly, and can be
+    spilled to / reloaded from a JSONL file (one row per line).
+    """
+
+    def __init__(self, rows=None):
+        self.rows = [row for row in (rows or []) if row]
+        self._dataframe = None
+
+    def dataframe(self):
+        if self._dataframe is None:
+            self._dataframe = insights_dataframe(self.rows)
+        return self._dataframe
+
+    def to_jsonl(self, path):
+        with open(path, "w", encoding="utf-8") as jsonl_file:
+            for row in self.rows:
+                jsonl_file.write(json.dumps(row) + "\n")
+
+    @classmethod
+    def from_jsonl(cls, path):
+        with open(path, "r", encoding="utf-8") as jsonl_file:
+            return cls([json.loads(line) for line in jsonl_file if line.strip()])
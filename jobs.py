@@ -0,0 +1,118 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from openai_service import RequestCancelled
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+class Job:
+    """One background task: its status, progress counters, live rows and final result.
+
+    The job thread writes through update()/add_row() and the UI reads
+    snapshot(), so a Streamlit rerun never blocks on the work itself.
+    """
+
+    def __init__(self, description):
+        self.id = uuid.uuid4().hex
+        self.description = description
+        self.status = "queued"
+        self.progress = {}
+        self.rows = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def is_finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def cancel(self):
+        # Pending requests are never sent and in-flight ones are abandoned at the next check
+        self.cancel_event.set()
+        with self.lock:
+            if not self.is_finished:
+                self.status = "cancelling"
+
+    def update(self, **progress):
+        with self.lock:
+            self.progress.update(progress)
+
+    def add_row(self, index, row):
+        # A streamed preview row is replaced by the final one, or dropped if the subsection failed after all
+        with self.lock:
+            if row:
+                self.rows[index] = row
+            else:
+                self.rows.pop(index, None)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "id": self.id,
+                "description": self.description,
+                "status": self.status,
+                "progress": dict(self.progress),
+                "rows": [self.rows[index] for index in sorted(self.rows)],
+                "error": self.error,
+                "elapsed": (self.finished or time.time()) - (self.started or time.time())
+            }
+
+class JobManager:
+    """Run jobs on a small pool of background threads and keep their state for polling.
+
+    submit(description, target, ...) calls target(job, ...) off the caller's
+    thread; the target reports progress on the job and should pass
+    job.cancel_event down to anything long-running. Raising RequestCancelled
+    marks the job cancelled rather than failed.
+    """
+
+    def __init__(self, max_running=2, keep_finished=20):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_running), thread_name_prefix="insights-job")
+        self.keep_finished = keep_finished
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, description, target, *args, **kwargs):
+        job = Job(description)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+        self.executor.submit(self._run, job, target, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job:
+            job.cancel()
+        return job
+
+    def _run(self, job, target, args, kwargs):
+        with job.lock:
+            if job.cancel_event.is_set():
+                job.status, job.finished = "cancelled", time.time()
+                return
+            job.status, job.started = "running", time.time()
+        try:
+            result = target(job, *args, **kwargs)
+            status, error = ("cancelled", None) if job.cancel_event.is_set() else ("done", None)
+        except RequestCancelled:
+            result, status, error = None, "cancelled", None
+        except Exception as e:
+            result, status, error = None, "failed", str(e)
+        with job.lock:
+            job.result, job.status, job.error, job.finished = result, status, error, time.time()
+
+    def _prune(self):
+        # Drop the oldest finished jobs beyond keep_finished
+        finished = sorted((job for job in self.jobs.values() if job.is_finished), key=lambda job: job.created)
+        for job in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job.id]
@@ -1,7 +1,21 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import yaml
+import hashlib
+import contextvars
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import nullcontext
 import streamlit as st
+from deployments import Deployment, DeploymentPool
+from hedging import HedgePolicy
+from rate_limiter import RateLimiter, retry_after_seconds
+from tracing import trace
 
 with open('config.yaml', 'r') as file:
     config = yaml.safe_load(file)
@@ -12,24 +26,142 @@ with open('config.yaml', 'r') as file:
 # deployment_name = config['openai']['deployment_name']
 # api_version = config['openai']['api_version']
 
-openai_endpoint = st.secrets["openai"]["openai_endpoint"]
-openai_api_key = st.secrets["openai"]["openai_api_key"]
-deployment_name = st.secrets["openai"]["deployment_name"]
-api_version = st.secrets["openai"]["api_version"]
-api_url = f"{openai_endpoint}openai/deployments/{deployment_name}/chat/completions?api-version={api_version}"
+def get_setting(section, key, default=None):
+    """Look up a setting in Streamlit secrets first, then in config.yaml."""
+    try:
+        if section in st.secrets and key in st.secrets[section]:
+            return st.secrets[section][key]
+    except FileNotFoundError:
+        # No secrets.toml (benchmarks, scripts run outside the app): config.yaml only
+        pass
+    return (config.get(section) or {}).get(key, default)
+
+openai_endpoint = get_setting("openai", "openai_endpoint")
+openai_api_key = get_setting("openai", "openai_api_key")
+deployment_name = get_setting("openai", "deployment_name")
+api_version = get_setting("openai", "api_version")
 
 headers = {
-    "Content-Type": "application/json",
-    "api-key": openai_api_key
+    "Content-Type": "application/json"
 }
 
-def send_to_openai(prompt_text):
-    payload = {
-    "messages": [
-        {
-            
-            "role": "system",
-            "content": '''You are an AI assistant specifically tasked with exactly parsing out each section of the given legal contract documents into JSON format. Please adhere to the following strict guidelines:
+# Connection pool, timeout and retry settings for the Azure OpenAI HTTP client
+pool_maxsize = get_setting("openai_http", "pool_maxsize", 16)
+connect_timeout = get_setting("openai_http", "connect_timeout", 10)
+read_timeout = get_setting("openai_http", "read_timeout", 180)
+max_retries = get_setting("openai_http", "max_retries", 5)
+backoff_factor = get_setting("openai_http", "backoff_factor", 1.0)
+backoff_max = get_setting("openai_http", "backoff_max", 60)
+# Whole-call limit from sending a request until its reply has fully arrived (read_timeout only bounds each read)
+request_deadline = get_setting("openai_http", "request_deadline", 300)
+# Stream replies as server-sent events: text arrives token by token, which gives time-to-first-token and lets rows show early
+stream_responses = get_setting("openai_http", "stream", True)
+
+# Client-side budget of each deployment's tokens/requests per minute, shared by every process on this host
+rate_limit_enabled = get_setting("rate_limit", "enabled", True)
+
+def make_rate_limiter(name, tokens_per_minute=None, requests_per_minute=None):
+    if not rate_limit_enabled:
+        return None
+    return RateLimiter(
+        name,
+        get_setting("rate_limit", "state_file", os.path.join("Insights", "rate_limit.json")),
+        tokens_per_minute=tokens_per_minute,
+        requests_per_minute=requests_per_minute,
+        burst_seconds=get_setting("rate_limit", "burst_seconds", 10)
+    )
+
+def load_deployments():
+    """The deployments listed under openai.deployments, or the single openai_endpoint/deployment_name one.
+
+    Entries leave out whatever they share with the top-level openai settings;
+    weight, tokens_per_minute and requests_per_minute are per deployment.
+    """
+    entries = [dict(entry) for entry in get_setting("openai", "deployments") or []]
+    if not entries:
+        entries = [{"tokens_per_minute": get_setting("rate_limit", "tokens_per_minute"),
+                    "requests_per_minute": get_setting("rate_limit", "requests_per_minute")}]
+    deployments = []
+    for entry in entries:
+        deployment = Deployment(entry.get("openai_endpoint", openai_endpoint), entry.get("openai_api_key", openai_api_key),
+                                entry.get("deployment_name", deployment_name), entry.get("api_version", api_version),
+                                weight=entry.get("weight", 1.0), name=entry.get("name"))
+        deployment.rate_limiter = make_rate_limiter(deployment.name, entry.get("tokens_per_minute"), entry.get("requests_per_minute"))
+        deployments.append(deployment)
+    return DeploymentPool(deployments)
+
+deployment_pool = load_deployments()
+
+def make_hedge_policy():
+    if not get_setting("hedging", "enabled", True):
+        return None
+    return HedgePolicy(
+        percentile=get_setting("hedging", "percentile", 95),
+        min_samples=get_setting("hedging", "min_samples", 20),
+        min_delay=get_setting("hedging", "min_delay", 2.0),
+        max_rate=get_setting("hedging", "max_rate", 0.05)
+    )
+
+hedge_policy = make_hedge_policy()
+# Replies are cached under the first deployment's name and API version: every deployment must serve the same model
+deployment_name = deployment_pool.deployments[0].deployment_name
+api_version = deployment_pool.deployments[0].api_version
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+class _ForcelistOnlyRetry(Retry):
+    # urllib3 also retries 413/429/503 replies carrying Retry-After that are not in status_forcelist;
+    # those are left to send_to_openai so that the rate limiter and the deployment health see them
+    def is_retry(self, method, status_code, has_retry_after=False):
+        return status_code in (self.status_forcelist or ()) and super().is_retry(method, status_code, has_retry_after)
+
+def get_http_session():
+    """Return the process-wide keep-alive session used for every Azure OpenAI call.
+
+    Connection errors are retried with exponential backoff. With a single
+    deployment, transient server errors (500/502/503/504) are retried the same
+    way, a Retry-After header from Azure taking precedence over the computed
+    delay, and so are throttling replies (429) when the rate limiter is off.
+    Everything else is left to send_to_openai, which fails over to another
+    deployment or waits for the rate limit.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            status_forcelist = ()
+            if len(deployment_pool) == 1:
+                rate_limited = deployment_pool.deployments[0].rate_limiter is not None
+                status_forcelist = (500, 502, 503, 504) if rate_limited else (429, 500, 502, 503, 504)
+            retry = _ForcelistOnlyRetry(
+                total=max_retries,
+                backoff_factor=backoff_factor,
+                backoff_max=backoff_max,
+                status_forcelist=status_forcelist,
+                allowed_methods=frozenset(["POST"]),
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=max(1, len(deployment_pool)), pool_maxsize=pool_maxsize, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(headers)
+            _http_session = session
+    return _http_session
+
+def use_deployments(pool):
+    """Route requests over another DeploymentPool (e.g. local stand-ins in a benchmark); returns the previous pool."""
+    global deployment_pool, _http_session
+    with _http_session_lock:
+        previous, deployment_pool = deployment_pool, pool
+        # The session's retry policy depends on the number of deployments
+        if _http_session is not None:
+            _http_session.close()
+            _http_session = None
+    return previous
+
+SYSTEM_PROMPT = '''You are an AI assistant specifically tasked with exactly parsing out each section of the given legal contract documents into JSON format. Please adhere to the following strict guidelines:
                  i. **only process that prompt_text which does not contain ................................pattern, must start with(eg. 1.).
   
                 1. **Extract Only the Following Elements**:
@@ -113,6 +245,490 @@ def send_to_openai(prompt_text):
                     "Assigned To": "NA"
                     }
                     - Each Json Block should contain information about one subsection, i.e. if "1. BACKGROUND, OBJECTIVES AND STRUCTURE" has four subsection, All four of them should have seperate Json block containing information correspoding to their text.'''
+
+# Sampling parameters sent with every request; they are part of the cache key
+SAMPLING_PARAMS = {
+    "max_tokens": 4096,
+    "temperature": 0.2,
+    "top_p": 0.95,
+    "frequency_penalty": 0,
+    "presence_penalty": 0
+}
+
+def estimate_tokens(text):
+    # Rough GPT tokenizer estimate (~4 characters per token for English contract text)
+    return (len(text) + 3) // 4
+
+SYSTEM_PROMPT_TOKENS = estimate_tokens(SYSTEM_PROMPT)
+
+class ResponseCache:
+    """SQLite-backed cache of model replies keyed by a hash of everything that shapes the reply.
+
+    The database can be shared by several processes (the app and batch runs).
+    A lock held by another process is waited on for up to busy_timeout
+    seconds; any database error after that counts as a miss on reads and is
+    skipped on writes, so the cache can never fail a request.
+    """
+
+    def __init__(self, path, max_size_mb=200, max_age_days=30, enabled=True, busy_timeout=5.0):
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.enabled = enabled
+        self.busy_timeout = busy_timeout
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def _connect(self):
+        # Opened lazily so that a disabled cache never touches the disk
+        if self.connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            try:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, reply TEXT NOT NULL, size INTEGER NOT NULL, "
+                    "created REAL NOT NULL, accessed REAL NOT NULL)"
+                )
+                connection.commit()
+            except sqlite3.Error:
+                connection.close()
+                raise
+            self.connection = connection
+        return self.connection
+
+    def _failed(self, error):
+        # Called with self.lock held: drop the half-done transaction and carry on without the cache
+        self.errors += 1
+        print(f"Response cache error ignored: {error}")
+        if self.connection is not None:
+            try:
+                self.connection.rollback()
+            except sqlite3.Error:
+                pass
+
+    @staticmethod
+    def make_key(system_prompt, prompt_text, deployment, version, params):
+        key_source = json.dumps({
+            "system_prompt": system_prompt,
+            "prompt_text": prompt_text,
+            "deployment_name": deployment,
+            "api_version": version,
+            "params": params
+        }, sort_keys=True)
+        return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self.lock:
+            try:
+                connection = self._connect()
+                row = connection.execute(
+                    "SELECT reply FROM responses WHERE key = ? AND created >= ?",
+                    (key, now - self.max_age_seconds)
+                ).fetchone()
+            except (sqlite3.Error, OSError) as e:
+                self._failed(e)
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            try:
+                connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                connection.commit()
+            except sqlite3.Error as e:
+                # The reply is still good; only its place in the eviction order is not updated
+                self._failed(e)
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, reply):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            try:
+                connection = self._connect()
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, reply, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, reply, len(reply.encode("utf-8")), now, now)
+                )
+                self._evict(connection, now)
+                connection.commit()
+            except (sqlite3.Error, OSError) as e:
+                self._failed(e)
+
+    def _evict(self, connection, now):
+        # Age-based eviction first, then drop least recently used entries until under the size limit
+        connection.execute("DELETE FROM responses WHERE created < ?", (now - self.max_age_seconds,))
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        stale_keys = []
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if total_size <= self.max_size_bytes:
+                break
+            stale_keys.append((key,))
+            total_size -= size
+        connection.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+
+    def delete(self, key):
+        if not self.enabled:
+            return
+        with self.lock:
+            try:
+                connection = self._connect()
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                connection.commit()
+            except (sqlite3.Error, OSError) as e:
+                self._failed(e)
+
+    def clear(self):
+        with self.lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM responses")
+            connection.commit()
+
+    def stats(self):
+        with self.lock:
+            entries, size = (0, 0)
+            if self.enabled:
+                try:
+                    entries, size = self._connect().execute(
+                        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+                    ).fetchone()
+                except (sqlite3.Error, OSError) as e:
+                    self._failed(e)
+                    entries, size = (None, None)
+            return {"hits": self.hits, "misses": self.misses, "errors": self.errors, "entries": entries, "size_bytes": size}
+
+response_cache = ResponseCache(
+    get_setting("openai_cache", "path", os.path.join("Insights", "openai_cache.sqlite3")),
+    max_size_mb=get_setting("openai_cache", "max_size_mb", 200),
+    max_age_days=get_setting("openai_cache", "max_age_days", 30),
+    enabled=get_setting("openai_cache", "enabled", True),
+    busy_timeout=get_setting("openai_cache", "busy_timeout_seconds", 5)
+)
+
+# Optional process-wide cap on requests in flight, shared by every caller (e.g. all documents of a batch run)
+_request_slots = None
+
+def limit_concurrent_requests(limit):
+    """Allow at most limit Azure OpenAI requests in flight across all threads (None removes the cap)."""
+    global _request_slots
+    _request_slots = threading.BoundedSemaphore(limit) if limit else None
+
+# Tokens billed by Azure OpenAI in this process, from the "usage" block of each reply (cache hits cost nothing)
+_usage = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+_usage_lock = threading.Lock()
+
+def usage_stats():
+    with _usage_lock:
+        return dict(_usage, total_tokens=_usage["prompt_tokens"] + _usage["completion_tokens"])
+
+def use_hedge_policy(policy):
+    """Hedge slow requests with another HedgePolicy (None turns hedging off); returns the previous one."""
+    global hedge_policy
+    previous, hedge_policy = hedge_policy, policy
+    return previous
+
+def hedge_stats():
+    """Requests, hedges sent and won, and the current hedge delay in this process; None with hedging off."""
+    return hedge_policy.stats() if hedge_policy is not None else None
+
+def deployment_health():
+    """Requests, failures, 429s, latency and cooldown of every deployment requests are routed to, in this process."""
+    return deployment_pool.health()
+
+def _record_usage(result):
+    usage = result.get("usage") or {}
+    with _usage_lock:
+        _usage["requests"] += 1
+        _usage["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        _usage["completion_tokens"] += usage.get("completion_tokens", 0)
+
+class RequestCancelled(Exception):
+    """The caller's cancel event was set before or while the request was in flight."""
+
+class DeadlineExceeded(requests.Timeout):
+    """No complete reply arrived within openai_http.request_deadline seconds of sending the request."""
+
+def _call_abandonable(call, cancel_event):
+    # The call runs on a helper thread so that a cancelled caller stops waiting straight away,
+    # including through retry back-off; the abandoned reply is discarded when it arrives
+    outcome = {}
+    finished = threading.Event()
+
+    def run():
+        try:
+            outcome["response"] = call()
+            if cancel_event.is_set():
+                # Nobody reads an abandoned reply: hand its connection back to the pool
+                outcome["response"].close()
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            finished.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    while not finished.wait(0.1):
+        if cancel_event.is_set():
+            raise RequestCancelled()
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["response"]
+
+def _post(deployment, payload, cancel_event=None):
+    def call():
+        return get_http_session().post(deployment.api_url, data=json.dumps(payload), headers={"api-key": deployment.api_key},
+                                       timeout=(connect_timeout, read_timeout), stream=stream_responses)
+    return call() if cancel_event is None else _call_abandonable(call, cancel_event)
+
+def _post_completion(payload, cancel_event, cost, span, exclude=()):
+    """POST a chat completion to the deployment the pool picks, failing over to the others.
+
+    The request waits until some deployment's rate limit lets it out. A 429,
+    a 5xx or a connection error is recorded against the deployment (see
+    Deployment.record) and the request goes to one not tried yet. Once all
+    were tried, a 429 waits for the shared rate limit (see
+    RateLimiter.observe) and is sent again. At most max_retries extra attempts
+    are made. Deployments in exclude are only used when there is no other.
+    """
+    tried = list(exclude)
+    for attempt in range(max_retries + 1):
+        while True:
+            deployment = deployment_pool.choose(cost, exclude=tried)
+            wait = deployment.rate_limiter.try_acquire(cost) if deployment.rate_limiter is not None else 0.0
+            if wait <= 0:
+                break
+            # Nothing is reserved while waiting, so the request goes to whichever deployment has budget first
+            pause = min(wait, 0.25)
+            if cancel_event is None:
+                time.sleep(pause)
+            elif cancel_event.wait(pause):
+                raise RequestCancelled()
+            span["rate_limit_wait_seconds"] = round(span.get("rate_limit_wait_seconds", 0) + pause, 3)
+        span["deployment"] = deployment.name
+        sent = time.perf_counter()
+        try:
+            response = _post(deployment, payload, cancel_event)
+        except requests.RequestException:
+            deployment.record(None)
+            tried.append(deployment.name)
+            if attempt == max_retries or not deployment_pool.has_untried(tried):
+                raise
+            span["failovers"] = span.get("failovers", 0) + 1
+            continue
+        status_code = response.status_code
+        deployment.record(status_code, time.perf_counter() - sent, retry_after_seconds(response.headers) if status_code == 429 else None)
+        if deployment.rate_limiter is not None:
+            deployment.rate_limiter.observe(status_code, response.headers, cost)
+        if status_code != 429 and status_code < 500:
+            return response
+        tried.append(deployment.name)
+        try_again = deployment_pool.has_untried(tried) or (status_code == 429 and deployment.rate_limiter is not None)
+        if attempt == max_retries or not try_again:
+            return response
+        if deployment_pool.has_untried(tried):
+            span["failovers"] = span.get("failovers", 0) + 1
+        else:
+            span["throttled"] = span.get("throttled", 0) + 1
+        response.close()
+
+def _read_event_stream(response, cancel_event=None, on_delta=None):
+    """Collect a streamed chat completion (server-sent events, one "data:" line per chunk).
+
+    Returns (content, usage, first_token_time, chunks): usage is None unless
+    the service sent it, first_token_time is a time.perf_counter() value.
+    on_delta(text) is called with every piece of content as it arrives.
+    """
+    parts = []
+    usage = first_token_time = None
+    chunks = 0
+    # Event streams carry no charset; without one requests would hand back bytes
+    response.encoding = "utf-8"
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelled()
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            usage = chunk.get("usage") or usage
+            # Azure sends content filter results in chunks without choices
+            for choice in chunk.get("choices") or []:
+                delta = (choice.get("delta") or {}).get("content")
+                if delta:
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter()
+                    chunks += 1
+                    parts.append(delta)
+                    if on_delta:
+                        on_delta(delta)
+    finally:
+        response.close()
+    return "".join(parts), usage, first_token_time, chunks
+
+def _attempt(payload, cost, cancel_event, on_delta, claim, span, exclude=()):
+    """Send one copy of a request and read its reply; returns (response, result, reply).
+
+    claim() is called as soon as the reply starts to arrive (the first streamed
+    token, or the whole reply when it is not streamed) and tells whether this
+    copy is the one whose text goes to on_delta; any other copy is still read
+    to the end, in case the first one fails. result and reply are None unless
+    the status is 200.
+    """
+    start = time.perf_counter()
+    response = _post_completion(payload, cancel_event, cost, span, exclude)
+    if response.status_code != 200:
+        return response, None, None
+    # A proxy or older API version may answer with a plain JSON body instead of an event stream
+    if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+        claim()
+        result = response.json()
+        return response, result, result['choices'][0]['message']['content']
+
+    claimed = []
+
+    def forward(delta):
+        if not claimed:
+            claimed.append(claim())
+        if claimed[0] and on_delta:
+            on_delta(delta)
+
+    reply, usage, first_token_time, chunks = _read_event_stream(response, cancel_event, forward)
+    if not claimed:
+        claim()
+    # Each content chunk is about one token; used when the service sends no usage block
+    result = {"usage": usage or {"prompt_tokens": cost - SAMPLING_PARAMS["max_tokens"], "completion_tokens": chunks}}
+    if first_token_time is not None:
+        span["ttft_seconds"] = round(first_token_time - start - span.get("rate_limit_wait_seconds", 0), 3)
+        generation_seconds = time.perf_counter() - first_token_time
+        if generation_seconds > 0:
+            span["tokens_per_second"] = round(result["usage"]["completion_tokens"] / generation_seconds, 1)
+    return response, result, reply
+
+def _race(payload, cost, cancel_event, on_delta, span):
+    """Run a request under the deadline, hedging it when it is slow; returns _attempt's result for the copy used.
+
+    The request runs on a worker thread. If no reply has started to arrive
+    after the hedge policy's delay, and the hedge rate allows it, a second copy
+    goes out, to another deployment when there is one. The copy whose reply
+    starts to arrive first streams its text to on_delta, but the first copy
+    to complete with a 200 is the one used; a copy that fails, even halfway
+    through its reply, leaves the field to the other. Once one is used the
+    other is abandoned. Both clocks start once the request is sent, so rate
+    limit waits don't count.
+    """
+    results = queue.Queue()
+    attempts = []
+    streaming = []
+    streaming_lock = threading.Lock()
+    policy = hedge_policy
+
+    def sent_seconds(attempt):
+        return time.perf_counter() - attempt["started"] - attempt["span"].get("rate_limit_wait_seconds", 0)
+
+    def launch(exclude=()):
+        number = len(attempts)
+        attempt = {"span": {}, "cancel": threading.Event(), "started": time.perf_counter()}
+        attempts.append(attempt)
+
+        def claim():
+            with streaming_lock:
+                if not streaming:
+                    streaming.append(number)
+                    if policy is not None:
+                        # When the hedge answers first, the first copy's latency is at least this long
+                        policy.record(sent_seconds(attempts[0]))
+                return streaming[0] == number
+
+        def run():
+            try:
+                results.put((number, _attempt(payload, cost, attempt["cancel"], on_delta, claim, attempt["span"], exclude), None))
+            except Exception as e:
+                results.put((number, None, e))
+
+        threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+
+    if policy is not None:
+        policy.request()
+    hedge_delay = policy.delay() if policy is not None else None
+    launch()
+    pending = 1
+    failure = None
+    try:
+        while pending:
+            try:
+                number, outcome, error = results.get(timeout=0.1)
+            except queue.Empty:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise RequestCancelled()
+                elapsed = sent_seconds(attempts[0])
+                if request_deadline and elapsed > request_deadline:
+                    span.update(attempts[-1]["span"])
+                    raise DeadlineExceeded(f"No complete reply within {request_deadline}s")
+                if hedge_delay is not None and elapsed > hedge_delay and not streaming:
+                    hedge_delay = None
+                    if policy.try_hedge():
+                        deployment = attempts[0]["span"].get("deployment")
+                        launch(exclude=[deployment] if deployment else ())
+                        pending += 1
+                continue
+            pending -= 1
+            span.update(attempts[number]["span"])
+            if len(attempts) > 1:
+                span["hedged"] = True
+                span["hedge_won"] = number > 0
+            if error is None and outcome[0].status_code == 200:
+                if number > 0:
+                    policy.hedge_won()
+                return outcome
+            failure = (outcome, error)
+        outcome, error = failure
+        if error is not None:
+            raise error
+        return outcome
+    finally:
+        for attempt in attempts:
+            attempt["cancel"].set()
+
+def discard_cached_response(prompt_text):
+    """Forget the cached reply to prompt_text (e.g. one that could not be parsed) so the next call asks the model again."""
+    response_cache.delete(ResponseCache.make_key(SYSTEM_PROMPT, prompt_text, deployment_name, api_version, SAMPLING_PARAMS))
+
+def send_to_openai(prompt_text, use_cache=True, cancel_event=None, on_delta=None):
+    """Return the model's reply to prompt_text, or None when the request failed.
+
+    With streaming on (openai_http.stream), on_delta(text) receives the reply
+    piece by piece while it is generated; cached replies are returned whole.
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise RequestCancelled()
+    cache_key = ResponseCache.make_key(SYSTEM_PROMPT, prompt_text, deployment_name, api_version, SAMPLING_PARAMS)
+    if use_cache:
+        with trace("response cache lookup", "cache") as span:
+            cached_reply = response_cache.get(cache_key)
+            span["hit"] = cached_reply is not None
+        if cached_reply is not None:
+            return cached_reply
+
+    payload = {
+    "messages": [
+        {
+            
+            "role": "system",
+            "content": SYSTEM_PROMPT
  
         },
         {
@@ -120,20 +736,37 @@ def send_to_openai(prompt_text):
             "content": prompt_text
         }
     ],
-    "max_tokens": 4096,
-    "temperature": 0.2,
-    "top_p": 0.95,
-    "frequency_penalty": 0,
-    "presence_penalty": 0
+    **SAMPLING_PARAMS
     }
+    if stream_responses:
+        payload["stream"] = True
  
-    response = requests.post(api_url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 200:
-        result = response.json()
-        reply = result['choices'][0]['message']['content']
-        return reply
-    else:
-        print(f"Request failed with status code {response.status_code}: {response.text}")
-        return None
+    with trace("chat completion", "llm", prompt_chars=len(prompt_text), stream=stream_responses) as span:
+        try:
+            with _request_slots or nullcontext():
+                # HTTP latency excludes the wait for a request slot but includes retries and rate limit waits
+                http_start = time.perf_counter()
+                try:
+                    # Azure counts the prompt plus max_tokens against the quota when the request arrives
+                    cost = SYSTEM_PROMPT_TOKENS + estimate_tokens(prompt_text) + SAMPLING_PARAMS["max_tokens"]
+                    response, result, reply = _race(payload, cost, cancel_event, on_delta, span)
+                finally:
+                    span["http_seconds"] = round(time.perf_counter() - http_start, 3)
+        except requests.RequestException as e:
+            span["error"] = str(e)
+            print(f"Request failed after retries: {e}")
+            return None
+        span["status"] = response.status_code
+        if response.status_code == 200:
+            _record_usage(result)
+            usage = result.get("usage") or {}
+            span["prompt_tokens"] = usage.get("prompt_tokens")
+            span["completion_tokens"] = usage.get("completion_tokens")
+            if use_cache:
+                response_cache.set(cache_key, reply)
+            return reply
+        else:
+            print(f"Request failed with status code {response.status_code}: {response.text}")
+            return None
  
  
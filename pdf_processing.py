@@ -1,118 +1,416 @@
+from collections import OrderedDict
 from io import BytesIO
 from pdfminer.high_level import extract_text
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import tempfile
+import threading
+import pymupdf
 import pdfplumber
 import requests
+import json
 import re
 
-def extract_text_from_pdf(pdf_data):
-    text = ""
-    with pdfplumber.open(pdf_data) as pdf:
-        for page in pdf.pages:
-            text += page.extract_text() + "\n"
-    return text
-
-def format_to_structure(text):
-    section_pattern = re.compile(r"^\d+\.\s+([A-Z\s]+)")
-    subsection_pattern = re.compile(r"^\d+\.\d+\s+")
-    bullet_pattern = re.compile(r"^\s*\(?([a-z])\)\s+(.+?)(?=\n\s*\(?[a-z]\)|\n\d+\.\d|\Z)", re.DOTALL | re.MULTILINE)
-    
-    # Pattern to match unwanted text patterns to be removed from lines
-    removal_pattern = re.compile(
-        r"\b\d{7,}\.\d{2}\b"                         # Matches '24336663.35'
-        r"|\b\d{5,}-\d{5,}\b"                        # Matches '230849-10007'
-        r"|\b\d+\s+Master Services Agreement\b"      # Matches '123 Master Services Agreement'
-        r"|Customer and Vendor Confidential Execution Version"  # Matches 'Customer and Vendor Confidential Execution Version'
-    )
-
-    formatted_text = ""
-    for line in text.splitlines():
-        # Remove unwanted patterns from the line
-        clean_line = removal_pattern.sub("", line).strip()
-        
-        if section_pattern.match(clean_line):
-            formatted_text += f"\n{clean_line}\n"
-        elif subsection_pattern.match(clean_line):
-            formatted_text += f"{clean_line}\n"
-        elif bullet_pattern.match(clean_line):
-            formatted_text += f"    {clean_line}\n"
-        else:
-            formatted_text += f"        {clean_line}\n"
+# Below this many pages per worker the process start-up cost outweighs the gain
+MIN_PAGES_PER_WORKER = 16
+
+DEFAULT_EXTRACTION_BACKEND = "pdfplumber"
+
+def _source_path(source):
+    # Paths, and file objects backed by a file on disk, can be reopened by name without copying the bytes
+    if isinstance(source, (str, os.PathLike)):
+        return source
+    name = getattr(source, "name", None)
+    return name if isinstance(name, str) and os.path.isfile(name) else None
+
+def _open_pymupdf(source):
+    path = _source_path(source)
+    if path:
+        return pymupdf.open(path)
+    # MappedBlob and BytesIO hand out a zero-copy view, which PyMuPDF reads in place
+    if hasattr(source, "getbuffer"):
+        return pymupdf.open(stream=memoryview(source.getbuffer()), filetype="pdf")
+    source.seek(0)
+    return pymupdf.open(stream=source.read(), filetype="pdf")
+
+def _pages_pdfplumber(source, start, stop):
+    with pdfplumber.open(source) as pdf:
+        for i in range(start, stop):
+            yield pdf.pages[i].extract_text() + "\n"
+
+def _pages_pdfminer(source, start, stop):
+    # pdfminer ends every page with a form feed, which gives one chunk per page
+    if not isinstance(source, (str, os.PathLike)):
+        source.seek(0)
+    text = extract_text(source, page_numbers=range(start, stop))
+    for page_text in text.split("\f")[:stop - start]:
+        yield page_text + "\n"
+
+def _pages_pymupdf(source, start, stop):
+    with _open_pymupdf(source) as doc:
+        for i in range(start, stop):
+            yield doc[i].get_text().rstrip("\n") + "\n"
+
+# Each backend takes (path or binary file-like, first page, end page) and yields one string per page
+EXTRACTION_BACKENDS = {
+    "pdfplumber": _pages_pdfplumber,
+    "pdfminer": _pages_pdfminer,
+    "pymupdf": _pages_pymupdf
+}
+
+def count_pdf_pages(source):
+    with _open_pymupdf(source) as doc:
+        return doc.page_count
+
+def render_pdf_page(source, page_number, zoom=1.0):
+    """Render one page (0-based) to PNG bytes with PyMuPDF; zoom 1.0 is 72 dpi."""
+    with _open_pymupdf(source) as doc:
+        return doc[page_number].get_pixmap(matrix=pymupdf.Matrix(zoom, zoom)).tobytes("png")
+
+class PreviewPageCache:
+    """Rendered preview pages, with a least-recently-used bound per document.
+
+    Each document version (path + ETag) keeps at most pages_per_document
+    rendered pages and at most max_documents versions are kept, so paging
+    through one long contract never pushes out the pages of the others.
+    """
+
+    def __init__(self, pages_per_document=64, max_documents=8):
+        self.pages_per_document = pages_per_document
+        self.max_documents = max_documents
+        self.documents = OrderedDict()
+        self.lock = threading.Lock()
+
+    def render(self, pdf_path, etag, page_number, zoom=1.0):
+        document_key = (pdf_path, etag)
+        page_key = (page_number, zoom)
+        with self.lock:
+            pages = self.documents.get(document_key)
+            if pages is not None and page_key in pages:
+                self.documents.move_to_end(document_key)
+                pages.move_to_end(page_key)
+                return pages[page_key]
+
+        # Rendered outside the lock so one slow page doesn't hold up the other sessions
+        png = render_pdf_page(pdf_path, page_number, zoom)
+        with self.lock:
+            pages = self.documents.setdefault(document_key, OrderedDict())
+            self.documents.move_to_end(document_key)
+            pages[page_key] = png
+            pages.move_to_end(page_key)
+            while len(pages) > self.pages_per_document:
+                pages.popitem(last=False)
+            while len(self.documents) > self.max_documents:
+                self.documents.popitem(last=False)
+        return png
+
+def _extract_page_range(backend, pdf_path, start, stop):
+    # Runs in a worker process: open the PDF independently and extract one shard of pages
+    return list(EXTRACTION_BACKENDS[backend](pdf_path, start, stop))
+
+def iter_pages_from_pdf(pdf_data, workers=1, backend=DEFAULT_EXTRACTION_BACKEND, min_pages_per_worker=MIN_PAGES_PER_WORKER, shard_pages=None):
+    """Yield the text of each page in order as soon as it has been extracted.
+
+    pdf_data can be a file path or a binary file-like object. backend is one of
+    EXTRACTION_BACKENDS. With workers > 1 each worker opens the PDF file on its
+    own (in-memory data is spooled to a temp file first), and page ranges of shard_pages pages (by
+    default two shards per worker) are extracted in a process pool; small
+    documents fall back to the serial path.
+    """
+    if backend not in EXTRACTION_BACKENDS:
+        raise ValueError(f"Unknown extraction backend '{backend}', expected one of {', '.join(EXTRACTION_BACKENDS)}")
+
+    page_count = count_pdf_pages(pdf_data)
+    workers = min(workers, page_count // max(1, min_pages_per_worker))
+    if workers <= 1:
+        yield from EXTRACTION_BACKENDS[backend](pdf_data, 0, page_count)
+        if not isinstance(pdf_data, (str, os.PathLike)):
+            pdf_data.seek(0)
+        return
+
+    temp_path = None
+    pdf_path = _source_path(pdf_data)
+    if not pdf_path:
+        pdf_data.seek(0)
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_file:
+            temp_file.write(pdf_data.read())
+        pdf_path = temp_path = temp_file.name
+        pdf_data.seek(0)
+
+    try:
+        # Two shards per worker keeps the pool busy when some pages are much slower than others
+        shard_count = min(page_count, workers * 2) if not shard_pages else -(-page_count // shard_pages)
+        bounds = [page_count * i // shard_count for i in range(shard_count + 1)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            # map hands shards back in page order even when later ones finish first
+            for shard in executor.map(_extract_page_range, [backend] * shard_count, [pdf_path] * shard_count, bounds[:-1], bounds[1:]):
+                yield from shard
+    finally:
+        if temp_path:
+            os.remove(temp_path)
+
+def extract_text_from_pdf(pdf_data, workers=1, backend=DEFAULT_EXTRACTION_BACKEND, min_pages_per_worker=MIN_PAGES_PER_WORKER):
+    """Extract the text of the whole PDF, see iter_pages_from_pdf for the options."""
+    return "".join(iter_pages_from_pdf(pdf_data, workers, backend, min_pages_per_worker))
 
-    return formatted_text
+# Patterns used by StructureParser, and by the two-pass reference parser in benchmark.py
+HEADING_PATTERN = re.compile(r"^\d+\.\s+([A-Z\s]+)")
+SECTION_PATTERN = re.compile(r"^(\d+\.)\s+(.*)", re.MULTILINE)
+SUBSECTION_PATTERN = re.compile(r"^(\d+\.\d+)\s+(.*)", re.MULTILINE)
+BULLET_PATTERN = re.compile(r"^\(([a-z])\)\s+(.*)", re.MULTILINE)
+REMOVAL_PATTERN = re.compile(
+    r"\b\d{7,}\.\d{2}\b"                         # Matches '24336663.35'
+    r"|\b\d{5,}-\d{5,}\b"                        # Matches '230849-10007'
+    r"|\b\d+\s+Master Services Agreement\b"      # Matches '123 Master Services Agreement'
+    r"|Customer and Vendor Confidential Execution Version"  # Matches 'Customer and Vendor Confidential Execution Version'
+)
+DIGIT_PATTERN = re.compile(r"\d")
 
-def parse_content_to_json(text):
-    content = {}
-    current_section = None
-    current_subsection = None
-    current_section_number = None
-    current_subsection_number = None
-    accumulated_text = ""
+class StructureParser:
+    """Single-pass parser for the section -> subsection -> bullets tree of a contract.
 
-    section_pattern = re.compile(r"^(\d+\.)\s+(.*)", re.MULTILINE)
-    subsection_pattern = re.compile(r"^(\d+\.\d+)\s+(.*)", re.MULTILINE)
-    bullet_pattern = re.compile(r"^\(([a-z])\)\s+(.*)", re.MULTILINE)
+    Feed it the raw extracted lines one at a time and call close() to get the
+    section -> subsection -> [bullet text] dict, without building and
+    re-splitting an intermediate formatted string (benchmark.py keeps that
+    two-pass version as the reference its output is checked against). Subsections whose end has
+    been seen can be collected with pop_completed() while parsing continues.
+    """
 
-    lines = text.splitlines()
+    def __init__(self):
+        self.content = {}
+        self.section = None
+        self.section_key = None
+        self.subsection = None
+        self.subsection_key = None
+        self.parts = []
+        self.completed = []
 
+    def _flush(self):
+        if self.parts:
+            text = "".join(self.parts)
+            if self.subsection:
+                self.content[self.section_key][self.subsection_key].append(text)
+            else:
+                self.content[self.section_key].setdefault("No Subsection", []).append(text)
+            self.parts = []
+
+    def _complete_open_subsection(self):
+        # Called at a heading boundary (after _flush), when no more text can reach the open subsection
+        if self.section_key is None:
+            return
+        subsection_key = self.subsection_key if self.subsection else "No Subsection"
+        details = self.content[self.section_key].get(subsection_key)
+        if details:
+            self.completed.append((self.section_key, subsection_key, details))
+
+    def pop_completed(self):
+        """Return the (section, subsection, bullets) units finished since the last call."""
+        completed, self.completed = self.completed, []
+        return completed
+
+    def feed(self, line):
+        # Every removal pattern but the banner needs a digit, so most lines can skip the substitution
+        if DIGIT_PATTERN.search(line) or "Customer and Vendor Confidential Execution Version" in line:
+            line = REMOVAL_PATTERN.sub("", line)
+        clean_line = line.strip()
+        if clean_line[:1].isdecimal() and HEADING_PATTERN.match(clean_line):
+            # The formatted text of the two-pass parser had a blank line in front of every section heading
+            self._parse_line("")
+        self._parse_line(clean_line)
+
+    def _parse_line(self, line):
+        first_char = line[:1]
+        if first_char.isdecimal():
+            section_match = SECTION_PATTERN.match(line)
+            if section_match:
+                self._flush()
+                self._complete_open_subsection()
+                self.section = section_match.group(2).strip()
+                self.section_key = f"{section_match.group(1)} {self.section}"
+                self.content[self.section_key] = {}
+                self.subsection = None
+                self.subsection_key = None
+                return
+
+            subsection_match = SUBSECTION_PATTERN.match(line)
+            if subsection_match and self.section:
+                self._flush()
+                self._complete_open_subsection()
+                self.subsection = subsection_match.group(2).strip()
+                self.subsection_key = f"{subsection_match.group(1)} {self.subsection}"
+                self.content[self.section_key][self.subsection_key] = []
+                return
+
+        bullet_match = BULLET_PATTERN.match(line) if first_char == "(" else None
+        if bullet_match:
+            self._flush()
+            self.parts = [f"({bullet_match.group(1)}) {bullet_match.group(2).strip()}"]
+        elif self.section:
+            self.parts.append(" " + line)
+
+    def close(self):
+        self._flush()
+        self._complete_open_subsection()
+        return self.content
+
+def parse_structure(lines):
+    """Build the section/subsection tree from an iterable of raw text lines in one pass."""
+    parser = StructureParser()
     for line in lines:
-        line = line.strip()
-
-        section_match = section_pattern.match(line)
-        if section_match:
-            if accumulated_text:
-                if current_subsection:
-                    content[f"{current_section_number} {current_section}"][f"{current_subsection_number} {current_subsection}"].append(accumulated_text)
-                else:
-                    if "No Subsection" not in content[f"{current_section_number} {current_section}"]:
-                        content[f"{current_section_number} {current_section}"]["No Subsection"] = []
-                    content[f"{current_section_number} {current_section}"]["No Subsection"].append(accumulated_text)
-                accumulated_text = ""
-            current_section_number = section_match.group(1)
-            current_section = section_match.group(2).strip()
-            content[f"{current_section_number} {current_section}"] = {}
-            current_subsection = None
-            current_subsection_number = None
+        parser.feed(line)
+    return parser.close()
+
+def extract_json_blocks(content):
+    # Everything between a pair of braces, one string per JSON block
+    return re.findall(r'\{[^{}]*\}', content)
+
+def scan_json_objects(content):
+    """Top-level {...} spans of content, string-aware; an object cut off by the end of content is included as is."""
+    objects = []
+    depth = 0
+    start = None
+    in_string = escaped = False
+    for position, char in enumerate(content):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = depth > 0
+        elif char == "{":
+            if depth == 0:
+                start = position
+            depth += 1
+        elif char == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                objects.append(content[start:position + 1])
+    if depth:
+        objects.append(content[start:])
+    return objects
+
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+def repair_json(text):
+    """Fix the usual ways model output breaks JSON: trailing commas, Python literals and truncation.
+
+    Raw newlines inside strings are left for json.loads(strict=False).
+    """
+    output = []
+    closers = []
+    in_string = escaped = False
+    position = 0
+    while position < len(text):
+        char = text[position]
+        if in_string:
+            output.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+            output.append(char)
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+            output.append(char)
+        elif char in "}]":
+            # Drop a trailing comma before the closing bracket
+            while output and output[-1].isspace():
+                output.pop()
+            if output and output[-1] == ",":
+                output.pop()
+            if closers:
+                closers.pop()
+            output.append(char)
+        elif char.isalpha():
+            # Any letter can start a bare word, not just ASCII ones (e.g. an unquoted "é")
+            match = re.match(r"\w+", text[position:])
+            word = match.group(0) if match else char
+            output.append(PYTHON_LITERALS.get(word, word))
+            position += len(word)
             continue
+        else:
+            output.append(char)
+        position += 1
+
+    # Close whatever a truncated reply left open
+    if in_string:
+        output.append('"')
+    while output and (output[-1].isspace() or output[-1] in ",:"):
+        output.pop()
+    output.extend(reversed(closers))
+    return "".join(output)
 
-        subsection_match = subsection_pattern.match(line)
-        if subsection_match and current_section:
-            if accumulated_text:
-                if current_subsection:
-                    content[f"{current_section_number} {current_section}"][f"{current_subsection_number} {current_subsection}"].append(accumulated_text)
-                else:
-                    if "No Subsection" not in content[f"{current_section_number} {current_section}"]:
-                        content[f"{current_section_number} {current_section}"]["No Subsection"] = []
-                    content[f"{current_section_number} {current_section}"]["No Subsection"].append(accumulated_text)
-                accumulated_text = ""
-            current_subsection_number = subsection_match.group(1)
-            current_subsection = subsection_match.group(2).strip()
-            content[f"{current_section_number} {current_section}"][f"{current_subsection_number} {current_subsection}"] = []
+def parse_json_blocks(content, repair=False):
+    """Parse every JSON object in a model reply; returns (blocks, errors), one error message per block that failed.
+
+    Without repair the blocks are found with extract_json_blocks and parsed
+    strictly, like the original remove_outside_braces + json.loads path. With
+    repair they are found with the string-aware scan_json_objects and cleaned
+    with repair_json first.
+    """
+    blocks, errors = [], []
+    for block_text in (scan_json_objects(content) if repair else extract_json_blocks(content)):
+        try:
+            block = json.loads(repair_json(block_text), strict=False) if repair else json.loads(block_text)
+        except Exception as e:
+            errors.append(f"{e} in {block_text[:80]!r}")
             continue
+        if isinstance(block, dict):
+            blocks.append(block)
+    return blocks, errors
 
-        bullet_match = bullet_pattern.match(line)
-        if bullet_match:
-            if accumulated_text:
-                if current_subsection:
-                    content[f"{current_section_number} {current_section}"][f"{current_subsection_number} {current_subsection}"].append(accumulated_text)
-                else:
-                    if "No Subsection" not in content[f"{current_section_number} {current_section}"]:
-                        content[f"{current_section_number} {current_section}"]["No Subsection"] = []
-                    content[f"{current_section_number} {current_section}"]["No Subsection"].append(accumulated_text)
-                accumulated_text = ""
-            bullet_content = bullet_match.group(2).strip()
-            accumulated_text = f"({bullet_match.group(1)}) {bullet_content}"
-        elif current_section:
-            accumulated_text += " " + line
-
-    if accumulated_text:
-        if current_subsection:
-            content[f"{current_section_number} {current_section}"][f"{current_subsection_number} {current_subsection}"].append(accumulated_text)
-        else:
-            if "No Subsection" not in content[f"{current_section_number} {current_section}"]:
-                content[f"{current_section_number} {current_section}"]["No Subsection"] = []
-            content[f"{current_section_number} {current_section}"]["No Subsection"].append(accumulated_text)
+class JsonBlockStream:
+    """Incremental parse_json_blocks for a reply that arrives piece by piece.
+
+    feed(text) returns the blocks that text completed. Braces are matched the
+    way scan_json_objects does, so a brace inside clause text does not end a
+    block; a block that fails to parse is skipped, so feed never raises.
+    """
+
+    def __init__(self, repair=False):
+        self.repair = repair
+        self.depth = 0
+        self.in_string = self.escaped = False
+        self.current = []
 
-    return content
+    def feed(self, text):
+        blocks = []
+        for char in text:
+            if self.depth:
+                self.current.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.depth > 0
+            elif char == "{":
+                if self.depth == 0:
+                    self.current = [char]
+                self.depth += 1
+            elif char == "}" and self.depth:
+                self.depth -= 1
+                if self.depth == 0:
+                    block_text = "".join(self.current)
+                    try:
+                        block = json.loads(repair_json(block_text), strict=False) if self.repair else json.loads(block_text)
+                    except Exception:
+                        # Only a preview: a block that can't be parsed here is left to the full parse of the reply
+                        continue
+                    if isinstance(block, dict):
+                        blocks.append(block)
+        return blocks
 
 def remove_outside_braces(content):
 
@@ -122,7 +420,7 @@ def remove_outside_braces(content):
  
     # Use a regular expression to extract everything inside braces
 
-    extracted_text = re.findall(r'\{[^{}]*\}', content)
+    extracted_text = extract_json_blocks(content)
  
     # Join the extracted parts into one string
 
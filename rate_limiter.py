@@ -0,0 +1,184 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# After a 429 the refill rate is cut to this share of the quota (never below MIN_RATE_FACTOR)
+# and every successful reply gives back RATE_RECOVERY of it
+THROTTLE_FACTOR = 0.7
+MIN_RATE_FACTOR = 0.25
+RATE_RECOVERY = 0.02
+
+@contextmanager
+def file_lock(path):
+    # Exclusive lock on a side file, shared with other processes; held only while shared files are read and written
+    with open(path, "a+b") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+class RateLimiter:
+    """Client-side token and request budget of one deployment, shared by every thread and process on the host.
+
+    Two token buckets (tokens, requests) refill continuously at the
+    deployment's per-minute quota and hold at most burst_seconds worth of it.
+    acquire(cost) waits until a request estimated at cost tokens (prompt plus
+    max_tokens, the way Azure counts it) fits and takes it from both.
+
+    The quota comes from the config or, when not set, is learned from the
+    x-ratelimit-remaining-* headers of the replies. observe() lowers the
+    buckets to what Azure reports as remaining, and a 429 pauses every client
+    until its Retry-After and slows the refill down until requests succeed
+    again. The state lives in a small JSON file guarded by a file lock, so all
+    Streamlit sessions and batch runs on the host draw from the same budget.
+    """
+
+    def __init__(self, name, state_path, tokens_per_minute=None, requests_per_minute=None, burst_seconds=10):
+        self.name = name
+        self.state_path = state_path
+        self.limits = {"tokens": tokens_per_minute or None, "requests": requests_per_minute or None}
+        self.burst_seconds = burst_seconds
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _state(self, write=True):
+        """Yield this limiter's state; with write, it is saved afterwards if the body changed it."""
+        directory = os.path.dirname(self.state_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with self.lock, file_lock(self.state_path + ".lock"):
+            try:
+                with open(self.state_path, "r", encoding="utf-8") as state_file:
+                    saved = state_file.read()
+                states = json.loads(saved)
+            except (FileNotFoundError, ValueError):
+                saved, states = None, {}
+            state = states.setdefault(self.name, {})
+            yield state
+            if not write or json.dumps(states) == saved:
+                return
+            # Written next to the final path and swapped in, so a crash never leaves a half-written file
+            with tempfile.NamedTemporaryFile("w", dir=directory or ".", suffix=".part", delete=False, encoding="utf-8") as temp_file:
+                json.dump(states, temp_file)
+            os.replace(temp_file.name, self.state_path)
+
+    def _limit(self, state, kind):
+        return self.limits[kind] or state.get(f"limit_{kind}")
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state.get("updated", now))
+        state["updated"] = now
+        factor = state.get("factor", 1.0)
+        for kind in ("tokens", "requests"):
+            limit = self._limit(state, kind)
+            if limit:
+                capacity = limit * self.burst_seconds / 60
+                state[kind] = min(capacity, state.get(kind, capacity) + elapsed * limit / 60 * factor)
+
+    def _wait(self, state, now, amounts):
+        wait = state.get("paused_until", 0) - now
+        factor = state.get("factor", 1.0)
+        for kind, amount in amounts.items():
+            limit = self._limit(state, kind)
+            if limit:
+                # A request larger than the whole burst goes out once the bucket is full and leaves it in debt
+                missing = min(amount, limit * self.burst_seconds / 60) - state[kind]
+                if missing > 0:
+                    wait = max(wait, missing / (limit / 60 * factor))
+        return wait
+
+    def delay(self, cost):
+        """Seconds a request of about cost tokens would have to wait right now, without taking anything."""
+        with self._state(write=False) as state:
+            now = time.time()
+            self._refill(state, now)
+            return max(0.0, self._wait(state, now, {"tokens": cost, "requests": 1}))
+
+    def try_acquire(self, cost):
+        """Take a request of about cost tokens from the budget if it fits now and return 0; otherwise the seconds to wait."""
+        with self._state() as state:
+            now = time.time()
+            # Refilled on a copy: a request that has to wait leaves the saved state (and the file) alone.
+            # Refilling later from the older timestamp comes to the same buckets.
+            refilled = dict(state)
+            self._refill(refilled, now)
+            amounts = {"tokens": cost, "requests": 1}
+            wait = self._wait(refilled, now, amounts)
+            if wait > 0:
+                return wait
+            state.update(refilled)
+            for kind, amount in amounts.items():
+                if self._limit(state, kind):
+                    state[kind] -= amount
+            return 0.0
+
+    def acquire(self, cost, cancel_event=None):
+        """Wait until a request of about cost tokens fits in the budget and take it.
+
+        Returns the seconds spent waiting, or None if cancel_event was set first.
+        """
+        start = time.perf_counter()
+        while True:
+            wait = self.try_acquire(cost)
+            if wait <= 0:
+                return time.perf_counter() - start
+            if cancel_event is None:
+                time.sleep(min(wait, 1.0))
+            elif cancel_event.wait(min(wait, 1.0)):
+                return None
+
+    def observe(self, status_code, headers, cost=0):
+        """Fold a reply into the shared state: remaining-quota headers, and for a 429 a pause and a slower refill."""
+        with self._state() as state:
+            now = time.time()
+            self._refill(state, now)
+            for kind, amount in (("tokens", cost), ("requests", 1)):
+                try:
+                    remaining = float(headers.get(f"x-ratelimit-remaining-{kind}"))
+                except (TypeError, ValueError):
+                    continue
+                if not self.limits[kind]:
+                    # What is left right after a request is at least the quota minus that request
+                    state[f"limit_{kind}"] = max(state.get(f"limit_{kind}", 0), remaining + amount)
+                    self._refill(state, now)
+                state[kind] = min(state.get(kind, remaining), remaining)
+            if status_code == 429:
+                # Throttled replies to requests that went out together only slow the refill down once
+                if state.get("paused_until", 0) <= now:
+                    state["factor"] = max(MIN_RATE_FACTOR, state.get("factor", 1.0) * THROTTLE_FACTOR)
+                state["paused_until"] = max(state.get("paused_until", 0), now + retry_after_seconds(headers))
+                state["throttled"] = state.get("throttled", 0) + 1
+            elif 200 <= status_code < 300:
+                state["factor"] = min(1.0, state.get("factor", 1.0) + RATE_RECOVERY)
+
+    def snapshot(self):
+        with self._state(write=False) as state:
+            self._refill(state, time.time())
+            return dict(state)
+
+def retry_after_seconds(headers, default=1.0):
+    # Azure sends retry-after-ms alongside the standard Retry-After (whole seconds)
+    for name, scale in (("retry-after-ms", 0.001), ("Retry-After", 1.0)):
+        try:
+            return float(headers.get(name)) * scale
+        except (TypeError, ValueError):
+            continue
+    return default
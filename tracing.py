@@ -0,0 +1,166 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def memory_usage():
+    """Return (current, peak) resident set size of this process in bytes; None where the platform can't tell."""
+    rss = peak = None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        rss, peak = info.rss, getattr(info, "peak_wset", None)
+    elif os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm", "r") as statm:
+            rss = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    if peak is None and resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return rss, peak
+
+class Tracer:
+    """Timed spans of one run (a document, an evaluation) with memory and token figures attached.
+
+    Spans are recorded from any thread. summary() aggregates them per stage,
+    to_json() keeps every span and to_chrome_trace() can be opened in
+    chrome://tracing or https://ui.perfetto.dev.
+    """
+
+    def __init__(self, name="run"):
+        self.name = name
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category="stage", **args):
+        """Time the body; the yielded dict can be filled with extra figures (tokens, status...) as it runs."""
+        memory_before = memory_usage()
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add(name, category, start, time.perf_counter(), args, memory_before)
+
+    def add(self, name, category, start, end, args=None, memory_before=None):
+        """Record a span; memory_before is memory_usage() at its start, to tell how much memory it took."""
+        args = dict(args or {})
+        rss, peak = memory_usage()
+        args.setdefault("rss_mb", round(rss / 2 ** 20, 1) if rss else None)
+        args.setdefault("peak_rss_mb", round(peak / 2 ** 20, 1) if peak else None)
+        if memory_before and memory_before[0] and rss:
+            rss_before, peak_before = memory_before
+            # The peak is the process-lifetime high-water mark: it only says something about this span if it rose
+            if peak and peak_before and peak > peak_before:
+                growth = peak - rss_before
+            else:
+                growth = rss - rss_before
+            args.setdefault("mem_growth_mb", round(max(0, growth) / 2 ** 20, 1))
+        thread = threading.current_thread()
+        with self.lock:
+            self.spans.append({
+                "name": name,
+                "category": category,
+                "start": start - self.origin,
+                "duration": end - start,
+                "thread": thread.name,
+                "thread_id": thread.ident,
+                "args": args
+            })
+
+    def summary(self):
+        """One row per (category, name): calls, total/mean/max seconds, tokens and memory.
+
+        max_mem_growth_mb is the most a single call added to the resident set
+        (its peak over the RSS at its start); process_peak_rss_mb is the
+        process-lifetime peak seen by the end of the stage's calls, so it never
+        goes down from one stage to the next.
+
+        Streamed model calls also get their mean time to first token and mean
+        generation speed (completion tokens per second after the first token).
+        """
+        with self.lock:
+            spans = list(self.spans)
+        rows = {}
+        for span in spans:
+            row = rows.setdefault((span["category"], span["name"]), {
+                "stage": span["name"], "category": span["category"], "calls": 0, "total_s": 0.0, "max_s": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0, "max_mem_growth_mb": None, "process_peak_rss_mb": None,
+                "ttft": [], "speeds": []
+            })
+            row["calls"] += 1
+            row["total_s"] += span["duration"]
+            row["max_s"] = max(row["max_s"], span["duration"])
+            row["prompt_tokens"] += span["args"].get("prompt_tokens") or 0
+            row["completion_tokens"] += span["args"].get("completion_tokens") or 0
+            if span["args"].get("peak_rss_mb") is not None:
+                row["process_peak_rss_mb"] = max(row["process_peak_rss_mb"] or 0, span["args"]["peak_rss_mb"])
+            if span["args"].get("mem_growth_mb") is not None:
+                row["max_mem_growth_mb"] = max(row["max_mem_growth_mb"] or 0, span["args"]["mem_growth_mb"])
+            if span["args"].get("ttft_seconds") is not None:
+                row["ttft"].append(span["args"]["ttft_seconds"])
+            if span["args"].get("tokens_per_second") is not None:
+                row["speeds"].append(span["args"]["tokens_per_second"])
+        for row in rows.values():
+            row["mean_s"] = row["total_s"] / row["calls"]
+            ttft, speeds = row.pop("ttft"), row.pop("speeds")
+            row["mean_ttft_s"] = sum(ttft) / len(ttft) if ttft else None
+            row["tokens_per_s"] = sum(speeds) / len(speeds) if speeds else None
+        return sorted(rows.values(), key=lambda row: row["total_s"], reverse=True)
+
+    def to_json(self):
+        with self.lock:
+            spans = list(self.spans)
+        return json.dumps({"name": self.name, "started": self.started, "spans": spans, "summary": self.summary()}, default=str)
+
+    def to_chrome_trace(self):
+        with self.lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.name}}]
+        for thread_id, thread_name in {span["thread_id"]: span["thread"] for span in spans}.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": thread_name}})
+        for span in spans:
+            events.append({"name": span["name"], "cat": span["category"], "ph": "X", "pid": pid, "tid": span["thread_id"],
+                           "ts": round(span["start"] * 1e6), "dur": round(span["duration"] * 1e6), "args": span["args"]})
+            if span["args"].get("rss_mb") is not None:
+                events.append({"name": "memory", "ph": "C", "pid": pid, "ts": round((span["start"] + span["duration"]) * 1e6),
+                               "args": {"rss_mb": span["args"]["rss_mb"]}})
+        return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, default=str)
+
+_current_tracer = contextvars.ContextVar("tracer", default=None)
+
+def current_tracer():
+    return _current_tracer.get()
+
+@contextmanager
+def use_tracer(tracer):
+    """Make tracer the target of trace() in this thread and in work submitted with contextvars.copy_context()."""
+    token = _current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current_tracer.reset(token)
+
+@contextmanager
+def trace(name, category="stage", **args):
+    """Record a span on the active tracer, if there is one; otherwise just run the body."""
+    tracer = _current_tracer.get()
+    if tracer is None:
+        yield args
+        return
+    with tracer.span(name, category, **args) as span_args:
+        yield span_args
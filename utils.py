@@ -1,127 +1,76 @@
-import json
 import pandas as pd
 from openpyxl import Workbook
-import openpyxl
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Alignment, PatternFill
-import os
+from openpyxl.utils import get_column_letter
 
-def createjsonobject(content):
- 
-# Format each block as a complete JSON object
-    formatted_objects = []
-    for i, obj in enumerate(content):
-        # Add braces around each split object to make it a valid JSON object
-        if not obj.startswith('{'):
-            obj = '{' + obj
-        if not obj.endswith('}'):
-            obj = obj + '}'
-        
-        # Parse the object to confirm it's valid JSON
-        try:
-            parsed_obj = json.loads(obj)
-            formatted_objects.append(parsed_obj)
-        except json.JSONDecodeError as e:
-            print(f"Error parsing object {i}: {e}")
-    return formatted_objects            
+def _clause_text(item):
+    # Check if 'Clause Text' is a list
+    if isinstance(item.get('Clause Text'), list):
+        # Remove any occurrences of "]" and join the remaining text with newlines
+        clean_clauses = [clause for clause in item['Clause Text'] if clause != "]"]
+        item = {**item, 'Clause Text': "\n".join(clean_clauses)}
+    return item
 
-def txttojson(input_txt):
-    # Load the file and split by line to handle each object individually
-    with open(input_txt, "r") as file:
-        lines = file.readlines()
-    
-    json_objects = []
-    current_object = ""
-    
-    for line in lines:
-        current_object += line
-        # Detect end of an object by checking if line ends with '}' and the object seems valid
-        if line.strip() == "}," or line.strip() == "}":
-            # Try parsing the accumulated JSON object
-            try:
-                json_obj = json.loads(current_object)
-                json_objects.append(json_obj)
-            except json.JSONDecodeError as e:
-                print(f"Skipping invalid JSON object due to error: {e}")
-            
-            # Reset the current object accumulator
-            current_object = ""
-    
-    return json_objects
+def insights_dataframe(rows):
+    """One row per insight, with "Clause Text" lists joined into newline-separated text (rows are not modified)."""
+    return pd.DataFrame([_clause_text(item) for item in rows])
 
+# Layout of the insights workbook
+EXCEL_COLUMN_WIDTHS = {"A": 30, "B": 60, "C": 40, "D": 20, "E": 20, "F": 20, "G": 20, "H": 20, "I": 30, "J": 90, "K": 90}
+EXCEL_WRAP_COLUMNS = ["J", "K"]  # Assuming "J" is "clause_text"; these are top-aligned and wrapped, the rest centered
+EXCEL_HEADER_HEIGHT = 30
+EXCEL_ROW_HEIGHT = 140
+EXCEL_HEADER_FILL = "78A2CC"
 
-def formatting_excel(unformatedexcel,blob_name):
-    workbook = openpyxl.load_workbook(unformatedexcel)
-    sheet = workbook.active
+def write_insights_excel(rows, output_excel_file):
+    """Write the formatted insights workbook in a single streaming pass.
 
-    # Remove '.pdf' extension from blob_name and add '.xlsx' extension
-    base_blob_name = blob_name.replace(".pdf", "")  # Remove .pdf from blob name
-    output_path = os.path.join("Insights", f"Insights_{base_blob_name}.xlsx")  # Save to "Insights" folder
+    Produces the same sheet as to_excel followed by the original formatting
+    pass (formatting_excel in benchmark.py): column widths, header fill and
+    height, row heights, alignment. It uses openpyxl's write-only mode, so
+    rows are streamed to disk once and the workbook is never reloaded.
+    """
+    records = [_clause_text(item) for item in rows]
+    # Columns in order of first appearance, like pd.DataFrame(records)
+    columns = list(dict.fromkeys(key for record in records for key in record))
 
-    # Set column widths
-    column_widths = {
-        "A": 30,  # Adjust the width for the first column
-        "B": 60, 
-        "C": 40,
-        "D": 20,
-        "E": 20,
-        "F": 20,
-        "G": 20,
-        "H": 20,
-        "I": 30,
-        "J": 90,  # Assuming "J" is "clause_text"
-        "K": 90  # Adjust width for other columns as needed
-    }
-
-    # Set widths for each specified column
-    for col, width in column_widths.items():
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Sheet1")
+    for col, width in EXCEL_COLUMN_WIDTHS.items():
         sheet.column_dimensions[col].width = width
+    sheet.row_dimensions[1].height = EXCEL_HEADER_HEIGHT
 
-    # Define header height and background color
-    header_row = 1  # Assuming the first row is the header
-    sheet.row_dimensions[header_row].height = 30  # Set the desired header height
-
-    # Define the fill for the background color
-    header_fill = PatternFill(start_color="78A2CC", end_color="78A2CC", fill_type="solid")
+    wrap_alignment = Alignment(vertical="top", wrap_text=True)
+    center_alignment = Alignment(horizontal="center", vertical="center")
+    alignments = [wrap_alignment if get_column_letter(i) in EXCEL_WRAP_COLUMNS else center_alignment
+                  for i in range(1, len(columns) + 1)]
+    header_fill = PatternFill(start_color=EXCEL_HEADER_FILL, end_color=EXCEL_HEADER_FILL, fill_type="solid")
 
-    # Apply background color to each cell in the header row
-    for cell in sheet[header_row]:
+    header = []
+    for name, alignment in zip(columns, alignments):
+        cell = WriteOnlyCell(sheet, value=name)
         cell.fill = header_fill
+        cell.alignment = alignment
+        header.append(cell)
+    sheet.append(header)
 
-    # Set height for all other rows
-    other_row_height = 140  # Adjust this to the desired height for all other rows
-    for row in range(2, sheet.max_row + 1):  # Start from the second row to the last row
-        sheet.row_dimensions[row].height = other_row_height
-
-    # Define columns to exclude from center alignment
-    exclude_columns = ["J", "K"]  # Assuming "J" is "clause_text", "L" is "notes", "M" is "task_description"
-
-    # Apply alignment settings
-    for row in sheet.iter_rows(min_row=1, max_row=sheet.max_row, min_col=1, max_col=sheet.max_column):
-        for cell in row:
-            # Check if cell column is in exclude list; if so, wrap text and top-align
-            if cell.column_letter in exclude_columns:
-                cell.alignment = Alignment(vertical="top", wrap_text=True)
-            else:
-                # Center-align both horizontally and vertically
-                cell.alignment = Alignment(horizontal="center", vertical="center")
+    for row, record in enumerate(records, start=2):
+        cells = []
+        for name, alignment in zip(columns, alignments):
+            value = record.get(name)
+            if isinstance(value, (list, dict)):
+                value = str(value)
+            cell = WriteOnlyCell(sheet, value=value)
+            cell.alignment = alignment
+            cells.append(cell)
+        # Write-only rows are serialized on append, so each height is only kept until its row is written
+        sheet.row_dimensions[row].height = EXCEL_ROW_HEIGHT
+        sheet.append(cells)
+        del sheet.row_dimensions[row]
 
-    # Save the workbook with a new name to avoid overwriting the original
-    os.remove(f"{base_blob_name}.txt")
-    os.remove(unformatedexcel)
-    workbook.save(output_path)
+    workbook.save(output_excel_file)
 
-def json_to_excel(formatted_json, output_excel_file,blob_name):
-    # Process each item in the data
-    for item in formatted_json:
-        # Check if 'Clause Text' is a list
-        if isinstance(item.get('Clause Text'), list):
-            # Remove any occurrences of "]" and join the remaining text with newlines
-            clean_clauses = [clause for clause in item['Clause Text'] if clause != "]"]
-            item['Clause Text'] = "\n".join(clean_clauses)
-    
-    # Create a DataFrame from the loaded JSON data
-    df = pd.DataFrame(formatted_json)
-    
-    # Write the DataFrame to an Excel file
-    df.to_excel(output_excel_file, index=False)
-    formatting_excel(output_excel_file,blob_name)
\ No newline at end of file
+def json_to_excel(formatted_json, output_excel_file):
+    # Write the formatted workbook straight to its final location in one pass
+    write_insights_excel(formatted_json, output_excel_file)